@@ -0,0 +1,204 @@
+# DiphoneSynth
+# asyncio interface to synthesis: blocking and CPU-bound stages run in an executor, a fixed number of utterances are
+# synthesised at once, and a cancelled request stops at the next block of diphones.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import audio_interface
+import diphone_synth
+import instrumentation
+import output_dsp
+
+
+CONCURRENCY = 4  # default number of utterances synthesised at once
+BLOCK_UNITS = 32  # diphones synthesised per executor call. a cancelled request stops within one block
+
+
+class SynthBusy(Exception):
+    """Raised instead of queueing a request when max_waiting requests are already waiting for a slot."""
+
+
+def take(iterator, n):
+    """Return the next n items of iterator as a list, fewer at the end."""
+    return list(itertools.islice(iterator, n))
+
+
+def join(chunks):
+    """Concatenate a block of chunks."""
+    return np.concatenate(chunks) if chunks else np.array([], dtype=np.int16)
+
+
+def feed_block(stage, chunks, volume, final=False):
+    """Concatenate a block of chunks and pass it through a streaming output stage, returning a copy of the output."""
+    return stage.feed(join(chunks), volume, final).copy()
+
+
+class AsyncSynth:
+    """
+    Async front end to a synth_server.SynthService, so one event loop can serve many synthesis requests at once.
+    Tokenising, concatenation, rescaling and every file read and write run in a thread pool, never on the event loop.
+    At most max_concurrent utterances are synthesised at once; further requests wait their turn, and with max_waiting
+    set, requests beyond that many waiting raise SynthBusy instead, e.g to answer 503. Each utterance is synthesised
+    BLOCK_UNITS diphones per executor call, so cancelling the awaiting task stops it at the next block.
+    Primarily, use await .synthesise(phrase, crossfade, volume), which returns an int16 ndarray,
+                   async for block in .stream(phrase, crossfade, volume), to get audio as it is synthesised,
+                   await .save(phrase, path, crossfade, volume),
+                   await .play(phrase, crossfade, volume), which stops playing if it is cancelled.
+    """
+
+    def __init__(self, service, max_concurrent=CONCURRENCY, max_waiting=None, executor=None):
+        self.service = service
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.executor = executor or ThreadPoolExecutor(max_concurrent, thread_name_prefix="async-synth")
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.waiting = 0  # requests waiting for a slot
+        self.stages = []  # idle streaming output stages, kept to reuse their buffers. at most one per slot
+        self.metrics = instrumentation.metrics
+
+    async def run(self, function, *args):
+        """Run a blocking function in the executor and wait for its result without blocking the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def acquire(self):
+        """Wait for a synthesis slot, or raise SynthBusy if too many requests are waiting already."""
+        if self.max_waiting is not None and self.slots.locked() and self.waiting >= self.max_waiting:
+            self.metrics.count("async_rejected")
+            raise SynthBusy("Too many synthesis requests waiting")
+        self.waiting += 1
+        try:
+            with self.metrics.stage("queue_wait"):
+                await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+
+    def prepare(self, phrase):
+        utt = diphone_synth.Utterance(phrase, self.service.lexicon)
+        utt.tokenise()
+        return utt.get_diphone_ids()
+
+    async def iter_blocks(self, phrase, crossfade):
+        """The audio of a phrase, a list of up to BLOCK_UNITS chunks at a time. The caller holds a slot."""
+        blocks = self.service.synth.stream_chunks(await self.run(self.prepare, phrase), crossfade)
+        while True:
+            chunks = await self.run(take, blocks, BLOCK_UNITS)
+            if not chunks:
+                return
+            yield chunks
+
+    async def synthesise(self, phrase, crossfade=False, volume=100):
+        """Turn a phrase into audio data at the service's rate, like SynthService.synthesise."""
+        if not 0 <= volume <= 100:
+            raise ValueError("volume expected a value between 0 and 100.")
+        await self.acquire()
+        try:
+            cache = self.service.cache
+            key = None
+            if cache is not None:
+                key = self.service.cache_key(phrase, crossfade, volume)
+                data = await self.run(cache.get, key)  # may read from the disk cache
+                self.metrics.count("utterance_cache_hits" if data is not None else "utterance_cache_misses")
+                if data is not None:
+                    return data
+
+            chunks = []
+            async for block in self.iter_blocks(phrase, crossfade):
+                chunks += block
+            data = await self.run(self.service.finish, await self.run(join, chunks), volume)
+
+            if cache is not None:
+                await self.run(cache.put, key, data)
+            return data
+        except asyncio.CancelledError:
+            self.metrics.count("async_cancelled")
+            raise
+        finally:
+            self.slots.release()
+
+    async def output_blocks(self, phrase, crossfade, volume):
+        """
+        The audio of a phrase resampled to the service's rate, with volume as a plain gain, a block at a time. The
+        caller holds a slot, and so one of the output stages.
+        """
+        stage = self.stages.pop() if self.stages else output_dsp.OutputStage(diphone_synth.SAMPLE_RATE,
+                                                                             self.service.rate)
+        try:
+            stage.reset()
+            async for chunks in self.iter_blocks(phrase, crossfade):
+                yield await self.run(feed_block, stage, chunks, volume)
+            tail = await self.run(feed_block, stage, [], volume, True)  # the output held back for lookahead
+            if len(tail):
+                yield tail
+        finally:
+            self.stages.append(stage)
+
+    async def stream(self, phrase, crossfade=False, volume=100):
+        """
+        Async generator of audio blocks, yielded as they are synthesised. Like the command line --stream, the peak
+        isn't known until the end, so volume is a plain gain. The slot is held until the generator is exhausted or
+        closed.
+        """
+        if not 0 <= volume <= 100:
+            raise ValueError("volume expected a value between 0 and 100.")
+        await self.acquire()
+        try:
+            async for block in self.output_blocks(phrase, crossfade, volume):
+                yield block
+        except asyncio.CancelledError:
+            self.metrics.count("async_cancelled")
+            raise
+        finally:
+            self.slots.release()
+
+    async def save(self, phrase, path, crossfade=False, volume=100):
+        """Synthesise a phrase and write it to a .wav file, without blocking the event loop."""
+        data = await self.synthesise(phrase, crossfade, volume)
+        await self.run(audio_interface.write_wav, path, data, self.service.rate)
+        return data
+
+    async def load(self, path):
+        """Decode a .wav file in the executor, returning (data, format, channels, sample_rate) like load_wav."""
+        return await self.run(audio_interface.load_wav, path)
+
+    async def play(self, phrase, crossfade=False, volume=100, frames_per_buffer=None):
+        """
+        Play a phrase as it is synthesised. Playback starts on the first block, and cancelling stops it straight away.
+        Returns the number of underruns.
+        """
+        if not 0 <= volume <= 100:
+            raise ValueError("volume expected a value between 0 and 100.")
+        output = audio_interface.Audio(rate=self.service.rate)
+        await self.acquire()
+        holding = True
+        try:
+            async for block in self.output_blocks(phrase, crossfade, volume):
+                if output.ring is None:
+                    await self.run(output.start_playback, frames_per_buffer, None, block)
+                else:
+                    await self.run(output.feed, block)  # blocks in the executor while the ring buffer is full
+            self.slots.release()  # synthesis is done, so the slot can go to the next request while this plays
+            holding = False
+            if output.ring is None:
+                return 0
+            output.finish_playback(wait=False)
+            while output.ostream.is_active():
+                await asyncio.sleep(0.01)
+            underruns = output.underruns
+            output.wait()  # finished, so this just closes the stream
+            return underruns
+        except asyncio.CancelledError:
+            output.stop()
+            self.metrics.count("async_cancelled")
+            raise
+        finally:
+            if holding:
+                self.slots.release()
+            output.terminate()
+
+    def close(self):
+        """Shut down the executor, once no more requests will be made."""
+        self.executor.shutdown(wait=True)
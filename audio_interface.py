@@ -1,16 +1,340 @@
-import pyaudio as pa
 import numpy as np
 import wave
+import os
+import struct
+import time
+import threading
+from collections import OrderedDict
+import instrumentation
+
+pa = None  # the pyaudio module, imported by load_pyaudio the first time audio is actually played
+
+# PortAudio's sample format codes, the same values as pyaudio.paInt16 etc., so formats can be handled without PyAudio
+PA_FLOAT32 = 0x01
+PA_INT32 = 0x02
+PA_INT24 = 0x04
+PA_INT16 = 0x08
+PA_INT8 = 0x10
+PA_UINT8 = 0x20
+SAMPLE_SIZES = {PA_FLOAT32: 4, PA_INT32: 4, PA_INT24: 3, PA_INT16: 2, PA_INT8: 1, PA_UINT8: 1}
+WIDTH_FORMATS = {1: PA_UINT8, 2: PA_INT16, 3: PA_INT24, 4: PA_FLOAT32}  # like pyaudio.get_format_from_width
 
 # define default audio format values
 CHUNK = 256
-FORMAT = pa.paInt16
+FORMAT = PA_INT16
 CHANNELS = 1
 SAMPLE_RATE = 48000
 MAX_AMP = 2**15  # for rescale
+RING_SECONDS = 2  # default capacity of the playback ring buffer
+UNIT_CACHE_BYTES = 64 * 2**20  # default size limit of the shared decoded unit cache
+
+
+def entry_size(entry):
+    """Size in bytes of a unit cache entry, i.e the samples of a (data, format, channels, sample_rate) tuple."""
+    return entry[0].nbytes
+
+
+class UnitCache:
+    """
+    Bounded, size-aware LRU cache of decoded .wav units, keyed by (path, mtime) so an edited file is reloaded.
+    One instance (unit_cache, below) is shared by every Audio object in the process. Cached arrays are read-only,
+    so callers that want to change the samples must copy them first.
+    Entries can be anything that size_of can measure, so the same class also caches other audio, e.g in synth_cache.
+    """
+
+    def __init__(self, max_bytes=UNIT_CACHE_BYTES, size_of=entry_size):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> entry, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached entry for key and mark it as most recently used, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        """Add an entry, evicting least recently used entries until the cache fits in max_bytes again."""
+        size = self.size_of(entry)
+        if size > self.max_bytes:
+            return  # would evict everything else and still not fit, so don't cache it at all
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self.size_of(self._entries.pop(key))
+            self._entries[key] = entry
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                old_key, old_entry = self._entries.popitem(last=False)
+                self.current_bytes -= self.size_of(old_entry)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry. The counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """Return a dict of hit/miss/eviction counters and current usage."""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._entries), "bytes": self.current_bytes, "max_bytes": self.max_bytes}
+
+
+unit_cache = UnitCache()  # process-wide cache shared by every Audio (and therefore every Synth) instance
+
+
+def load_pyaudio():
+    """
+    Import PyAudio on first use and return the module. Only playback needs it, so loading, synthesising and saving
+    audio never import it, and never initialise PortAudio.
+    """
+    global pa
+    if pa is None:
+        import pyaudio
+        pa = pyaudio
+    return pa
+
 
+def get_nptype(type):
+    """Convert common pyaudio types to numpy types."""
+    if type == PA_INT24:
+        return np.int24
+    elif type == PA_INT16:
+        return np.int16
+    elif type == PA_INT8:
+        return np.int8
 
-class Audio(pa.PyAudio):
+
+def load_wav(path, cache=True):
+    """
+    Decode a .wav file in one bulk read, without opening an audio device. Returns a tuple of
+    (data, format, channels, sample_rate), where data is a read-only ndarray. Results are kept in the shared
+    unit_cache, so loading the same file again doesn't touch the disk.
+    """
+    key = (path, os.stat(path).st_mtime_ns) if cache else None
+    entry = unit_cache.get(key) if cache else None
+    if cache:
+        instrumentation.metrics.count("unit_cache_hits" if entry is not None else "unit_cache_misses")
+    if entry is None:
+        wave_file = wave.open(path, "rb")
+        format = WIDTH_FORMATS[wave_file.getsampwidth()]  # get format info from header
+        channels = wave_file.getnchannels()  # get number of channels from header
+        sample_rate = wave_file.getframerate()  # get sample rate from header
+        raw_data = wave_file.readframes(wave_file.getnframes())  # read every frame at once
+        wave_file.close()
+        data = np.frombuffer(raw_data, dtype=get_nptype(format))  # wraps the bytes without copying them
+        instrumentation.metrics.count("bytes_loaded", len(raw_data))
+        entry = (data, format, channels, sample_rate)
+        if cache:
+            unit_cache.put(key, entry)
+    return entry
+
+
+def write_wav(path, data, rate=SAMPLE_RATE, channels=CHANNELS, format=FORMAT):
+    """Write audio data to a .wav file, without opening an audio device. path can also be a writable file object."""
+    with instrumentation.metrics.stage("save", bytes=data.nbytes):
+        wav_file = wave.open(path, 'wb')
+        wav_file.setnchannels(channels)  # set channel info for header
+        wav_file.setsampwidth(SAMPLE_SIZES[format])  # set format info
+        wav_file.setframerate(rate)   # set sample rate info
+        wav_file.writeframes(data.tobytes())  # write the data
+        wav_file.close()  # close the file
+
+
+class WavTooLarge(ValueError):
+    """Raised by WavWriter.write instead of taking a .wav file past the 4 GiB its 32-bit sizes can describe."""
+
+
+class WavWriter:
+    """
+    Write 16-bit (or 8-bit) PCM to a .wav file a block at a time, so the whole recording never has to be in memory.
+    The header is written first with zero sizes, and patched with the real sizes by .close(). The sizes are 32-bit, so
+    a block that would take the data past MAX_DATA_BYTES (about 4 GiB, 37 hours of 16 kHz 16-bit mono) raises
+    WavTooLarge before anything of it is written, and the file closes as a valid .wav of everything before it.
+    Primarily, use with WavWriter(path, rate) as writer: writer.write(block), ...
+    """
+
+    HEADER_BYTES = 44  # the samples start straight after the RIFF, fmt and data headers
+    MAX_DATA_BYTES = 2**32 - 1 - 36  # the RIFF size, 36 + data bytes, has to fit in 32 bits
+
+    def __init__(self, path, rate=SAMPLE_RATE, channels=CHANNELS, format=FORMAT):
+        self.path = path
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = SAMPLE_SIZES[format]
+        self.frames = 0
+        self.file = open(path, "wb")
+        self.file.write(self.header(0))
+
+    def header(self, data_bytes):
+        block_align = self.channels * self.sample_width
+        return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_bytes, b"WAVE", b"fmt ", 16, 1, self.channels,
+                           self.rate, self.rate * block_align, block_align, self.sample_width * 8, b"data", data_bytes)
+
+    def write(self, data):
+        """Append a block of samples to the file."""
+        data = memoryview(np.ascontiguousarray(data)).cast("B")
+        if self.frames * self.channels * self.sample_width + len(data) > self.MAX_DATA_BYTES:
+            raise WavTooLarge("Too much audio for one .wav file, which holds at most 4 GiB of samples. Stopped after " +
+                              str(round(self.frames / self.rate / 3600, 1)) + " hours of audio")
+        self.file.write(data)
+        self.frames += len(data) // (self.channels * self.sample_width)
+
+    def close(self):
+        """Patch the header with the final sizes and close the file."""
+        if self.file.closed:
+            return
+        self.file.seek(0)
+        self.file.write(self.header(self.frames * self.channels * self.sample_width))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def peak(data):
+    """Largest absolute sample value. Unlike np.abs, this doesn't overflow on the most negative int16 sample."""
+    return max(int(data.max()), -int(data.min())) if len(data) else 0
+
+
+def fixed_gain(data, factor, out=None, scratch=None):
+    """
+    Multiply int16 data by a non-negative factor in fixed point, with no floating point temporaries: one int32
+    multiply by the factor in as many fractional bits as the product has room for, a rounding shift and a clip to the
+    sample range. Pass out=data to work in place, and scratch, an int32 buffer at least len(data) long, to reuse it
+    between calls. Returns out.
+    """
+    if out is None:
+        out = np.empty_like(data)
+    if scratch is None or len(scratch) < len(data):
+        scratch = np.empty(len(data), dtype=np.int32)
+    work = scratch[:len(data)]
+
+    factor = min(factor, MAX_AMP)  # any larger factor clips every non-zero sample anyway
+    shift = 15 - max(0, int(np.ceil(np.log2(factor)))) if factor > 0 else 15  # |sample * gain| stays below 2**31
+    np.multiply(data, np.int32(round(factor * 2**shift)), out=work)
+    if shift:
+        work += 1 << (shift - 1)  # round to nearest rather than towards minus infinity
+        np.right_shift(work, shift, out=work)
+    np.clip(work, -MAX_AMP, MAX_AMP - 1, out=work)
+    np.copyto(out, work, casting="unsafe")
+    return out
+
+
+def gain(data, factor):
+    """Return a copy of data multiplied by factor, clipped to the sample range."""
+    return fixed_gain(data, factor)
+
+
+def rescale(data, factor, out=None, scratch=None):
+    """
+    Return a copy of data with its peak scaled to factor (between 0 and 1) of full scale. Silence is returned as-is.
+    out and scratch are as in fixed_gain, e.g out=data to rescale in place.
+    """
+    with instrumentation.metrics.stage("rescale", samples=len(data)):
+        data_peak = peak(data)  # define peak to prevent clipping
+        if data_peak == 0:
+            return data
+        rescale_factor = factor * MAX_AMP / data_peak  # multiply every data point in the array by rescale factor
+        return fixed_gain(data, rescale_factor, out, scratch)
+
+
+class RingBuffer:
+    """
+    Fixed-size ring buffer of samples between a producer (the synthesiser) and the PortAudio callback thread.
+    write() blocks while the buffer is full, which gives the producer backpressure. read() hands out a zero-copy
+    memoryview of the buffer whenever the requested samples don't wrap around the end; the samples it hands out are
+    only released for overwriting at the next read(), once PortAudio has copied them.
+    """
+
+    def __init__(self, capacity, dtype=np.int16):
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.scratch = np.zeros(0, dtype=dtype)  # for reads that wrap around or need padding
+        self.capacity = capacity
+        self.write_count = 0  # total samples ever written
+        self.read_count = 0  # total samples ever handed out
+        self.held = 0  # samples handed out by the last read, not yet released
+        self.closed = False  # no more writes are coming
+        self._condition = threading.Condition()
+
+    def available(self):
+        return self.write_count - self.read_count
+
+    def write(self, data):
+        """Copy data into the buffer, waiting for the reader to make room whenever it is full."""
+        data = np.asarray(data, dtype=self.buffer.dtype)
+        written = 0
+        while written < len(data):
+            with self._condition:
+                while self.write_count - self.read_count + self.held >= self.capacity and not self.closed:
+                    self._condition.wait()
+                if self.closed:
+                    return  # playback was stopped, so the rest of the data has nowhere to go
+                free = self.capacity - (self.write_count - self.read_count + self.held)
+                start = self.write_count % self.capacity
+                n = min(free, len(data) - written, self.capacity - start)  # stop at the end, wrap next time round
+                self.buffer[start:start + n] = data[written:written + n]
+                self.write_count += n
+                written += n
+                self._condition.notify_all()
+
+    def close(self):
+        """Mark the end of the data, so the reader knows an empty buffer means finished rather than underrun."""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def read(self, count):
+        """
+        Release the previous read and return (view, underrun). view holds count samples, or fewer once the buffer is
+        closed and drained. If it ran dry before being closed, the missing samples are zeroes and underrun is True.
+        """
+        with self._condition:
+            self.held = 0
+            self._condition.notify_all()
+            n = min(count, self.available())
+            start = self.read_count % self.capacity
+            underrun = n < count and not self.closed
+            if start + n <= self.capacity and not underrun:
+                view = self.buffer[start:start + n]  # contiguous, so no copy
+            else:
+                if len(self.scratch) < count:
+                    self.scratch = np.zeros(count, dtype=self.buffer.dtype)
+                first = min(n, self.capacity - start)
+                self.scratch[:first] = self.buffer[start:start + first]
+                self.scratch[first:n] = self.buffer[:n - first]
+                if underrun:
+                    self.scratch[n:count] = 0
+                    view = self.scratch[:count]
+                else:
+                    view = self.scratch[:n]
+            self.read_count += n
+            self.held = n
+            return memoryview(view).cast("B"), underrun
+
+    def drained(self):
+        with self._condition:
+            return self.closed and self.available() == 0
+
+
+class Audio:
     """
     Audio object with functions to play .wav data as audio, save data to new .wav, and change volume
     based on a factor from 0 to 1.
@@ -18,10 +342,14 @@ class Audio(pa.PyAudio):
     Primarily, use .play(),
                    .save(filename), where filename is a string ending in '.wav'
                    .rescale(factor), where factor is a float or int between 0 and 1
+    Playback runs in PyAudio's callback mode, fed from a ring buffer, so .play(wait=False) returns straight away and
+    .start_playback(), .feed(data), .finish_playback() let the caller keep synthesising while audio plays.
+    PortAudio is only initialised when something is first played, so an Audio used just to load, rescale and save
+    data never touches the audio device.
     """
 
     def __init__(self, channels=1, rate=SAMPLE_RATE, chunk=CHUNK, format=FORMAT):
-        pa.PyAudio.__init__(self)  # initialise parent class
+        self.pyaudio = None  # the pyaudio.PyAudio instance, created by .open() on first use
         self.channels = channels
         self.sample_rate = rate
         self.chunk = chunk
@@ -30,19 +358,35 @@ class Audio(pa.PyAudio):
         self.data = np.array([], dtype=self.nptype)  # set the current data to an empty array of the correct type
         self.ostream = None  # a closed output stream
         self.chunk_index = 0  # a counter for referencing the data in chunks
+        self.ring = None  # the ring buffer feeding the callback while playing
+        self.underruns = 0  # callbacks that found the ring buffer empty before the end of the data
+        self.metrics = instrumentation.metrics  # where stage timings and counts go, see instrumentation.Metrics
+        self.playback_start = None  # when the current playback was started, for the "play" stage
 
     def __del__(self):
         self.terminate()
 
+    def open(self, *args, **kwargs):
+        """Open a PyAudio stream, initialising PortAudio first if this is the first stream."""
+        if self.pyaudio is None:
+            self.pyaudio = load_pyaudio().PyAudio()
+        return self.pyaudio.open(*args, **kwargs)
+
+    def terminate(self):
+        """Release PortAudio, if it was ever initialised."""
+        if self.pyaudio is not None:
+            self.pyaudio.terminate()
+            self.pyaudio = None
+
     def add_chunk(self):
         """Add a chunk of data into the current output stream."""
         slice_from = self.chunk_index * self.chunk
-        slice_to = slice_from + self.chunk - 1
+        slice_to = slice_from + self.chunk
         # numpy does not raise indexerror when slicing out of bounds, so check it here
-        if slice_to > self.data.shape[0]:
+        if slice_from >= self.data.shape[0]:
             raise IndexError
-        array = self.data[slice_from:slice_to]
-        self.ostream.write(array.tostring())
+        array = self.data[slice_from:slice_to]  # the last chunk may be shorter
+        self.ostream.write(memoryview(np.ascontiguousarray(array)).cast("B"))
         self.chunk_index += 1
 
     def open_output_stream(self):
@@ -55,57 +399,126 @@ class Audio(pa.PyAudio):
         self.ostream.close()
         self.ostream = None
 
-    def load(self, path):
-        """Load audio data from a given .wav file."""
-        wave_file = wave.open(path, "rb")
-        self.format = self.get_format_from_width(wave_file.getsampwidth())  # get format info from header
+    def load(self, path, cache=True):
+        """
+        Load audio data from a given .wav file. The whole file is decoded in one bulk read, and the result is kept
+        in the shared unit_cache so loading the same file again doesn't touch the disk. The loaded data is read-only.
+        """
+        self.data, self.format, self.channels, self.sample_rate = load_wav(path, cache)
         self.nptype = self.get_nptype(self.format)  # get nptype from format
-        self.channels = wave_file.getnchannels()  # get number of channels from header
-        self.sample_rate = wave_file.getframerate()  # get sample rate from header
-        self.data = np.array([], dtype=self.nptype)  # make an empty ndarray to write to
-        raw_data = wave_file.readframes(self.chunk)  # read a data chunk from the file
-        while raw_data:  # while there is still data in the file...
-            array = np.fromstring(raw_data, dtype=self.nptype)  # make an ndarray from the raw data
-            self.data = np.append(self.data, array)  # add it to the full data array
-            raw_data = wave_file.readframes(self.chunk)  # start reading the next chunk
-        wave_file.close()
 
-    def play(self):
-        """Play given audio data."""
-        self.open_output_stream()
+    def playback_callback(self, in_data, frame_count, time_info, status):
+        """PortAudio callback: hand over the next frame_count frames from the ring buffer."""
+        if status & pa.paOutputUnderflow:
+            self.underruns += 1
+        view, underrun = self.ring.read(frame_count * self.channels)
+        if underrun:
+            self.underruns += 1
+            return view, pa.paContinue  # padded with silence, keep going
+        if len(view) < frame_count * self.channels * self.ring.buffer.itemsize:
+            return view, pa.paComplete  # the final, partial buffer
+        return view, pa.paContinue
+
+    def start_playback(self, frames_per_buffer=None, capacity=None, data=None, close=False):
+        """
+        Open a callback-mode output stream fed by a ring buffer holding capacity samples (RING_SECONDS by default),
+        queue any initial data, and start it. Then .feed() more data as it becomes available and call
+        .finish_playback() at the end. With close, data is all there is: if it fits, the ring is closed before the
+        stream starts, so the first callback sees the end of a short clip rather than an underrun.
+        """
+        self.ring = RingBuffer(capacity or int(self.sample_rate * self.channels * RING_SECONDS), self.nptype)
+        self.underruns = 0
+        self.playback_start = time.perf_counter()
+        self.metrics.peak("buffer_bytes", self.ring.buffer.nbytes)
+        if data is not None:
+            self.ring.write(data[:self.ring.capacity])  # queued before starting, so the first callback has data
+            data = data[self.ring.capacity:]
+        if close and (data is None or not len(data)):
+            self.ring.close()
+        self.ostream = self.open(format=self.format, channels=self.channels, rate=self.sample_rate, output=True,
+                                 frames_per_buffer=frames_per_buffer or self.chunk,
+                                 stream_callback=self.playback_callback)
+        self.ostream.start_stream()
         print("Playing...")
-        while True:
-            try:    
-                self.add_chunk()
-            except IndexError:
-                break  # if we run out of data to output, break out of the loop
-        print("Stopped playing")
+        if data is not None and len(data):
+            self.feed(data)
+            if close:
+                self.ring.close()
+
+    def feed(self, data):
+        """Queue data for playback. Blocks only while the ring buffer is full."""
+        self.ring.write(data)
+
+    def finish_playback(self, wait=True):
+        """
+        Mark the end of the data. With wait, block until it has all played, then close the stream. Returns the
+        number of underruns, i.e times the callback ran out of data because it wasn't fed fast enough.
+        """
+        self.ring.close()
+        if wait:
+            self.wait()
+        return self.underruns
+
+    def stop(self):
+        """
+        Stop the current playback straight away, dropping whatever is still queued, and close its stream. A .feed()
+        blocked in another thread returns.
+        """
+        if self.ring is not None:
+            self.ring.close()
+        if self.ostream is not None:
+            self.ostream.stop_stream()
+            self.wait()
+
+    def wait(self):
+        """Block until the current playback has finished, then close its stream."""
+        if self.ostream is None:
+            return
+        while self.ostream.is_active():
+            time.sleep(0.01)
         self.close_output_stream()
+        self.ring = None
+        self.metrics.record("play", time.perf_counter() - self.playback_start, underruns=self.underruns)
+        self.metrics.count("underruns", self.underruns)
+        if self.underruns:
+            print("Stopped playing,", self.underruns, "underruns")
+        else:
+            print("Stopped playing")
+
+    def play(self, frames_per_buffer=None, wait=True):
+        """Play given audio data. With wait=False, return as soon as it starts and call .wait() later."""
+        # room for all of it, so nothing waits on the callback
+        self.start_playback(frames_per_buffer, capacity=max(len(self.data), 1), data=self.data, close=True)
+        self.finish_playback(wait)
+
+    def play_stream(self, blocks, frames_per_buffer=None):
+        """
+        Play audio data from an iterable of ndarray blocks, queueing each block as soon as it arrives instead of
+        waiting for the whole utterance, so producing the next block overlaps with playing this one. Afterwards,
+        self.data holds everything that was played, e.g so it can be saved.
+        """
+        played_blocks = []
+        for block in blocks:
+            if self.ring is None:
+                self.start_playback(frames_per_buffer, data=block)  # start once the first block is ready
+            else:
+                self.feed(block)
+            played_blocks.append(block)
+        if self.ring is not None:
+            self.finish_playback()
+        self.data = np.concatenate(played_blocks) if played_blocks else np.array([], dtype=self.nptype)
 
     def save(self, path):
         """Save audio data to a .wav file."""
-        raw_data = self.data.tostring()  # cast data to string for writing
-        wav_file = wave.open(path, 'wb')
-        wav_file.setnchannels(self.channels)  # set channel info for header
-        wav_file.setsampwidth(self.get_sample_size(self.format))  # set format info
-        wav_file.setframerate(self.sample_rate)   # set sample rate info
-        wav_file.writeframes(raw_data)  # write the data
-        wav_file.close()  # close the file
+        write_wav(path, self.data, self.sample_rate, self.channels, self.format)
 
     def get_nptype(self, type):
         """Convert common pyaudio types to numpy types."""
-        if type == pa.paInt24:
-            return np.int24
-        elif type == pa.paInt16:
-            return np.int16
-        elif type == pa.paInt8:
-            return np.int8
+        return get_nptype(type)
 
     def rescale(self, factor):
         """Change audio volume based on a given rescale factor between 0 and 1, independent of system volume."""
         if 0 <= factor <= 1:
-            peak = np.max(np.abs(self.data))  # define peak to prevent clipping
-            rescale_factor = factor * MAX_AMP / peak  # multiply every data point in the array by rescale factor
-            self.data = (self.data * rescale_factor).astype(self.nptype)
+            self.data = rescale(self.data, factor)
         else:
             print("Expected a scaling factor between 0 and 1")
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# DiphoneSynth
+# Batch synthesis: read a manifest of phrases and synthesise each one to its own .wav across a pool of processes.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import os
+import re
+import sys
+import csv
+import time
+import argparse
+import multiprocessing
+import audio_interface
+import diphone_synth
+import lexicon
+import output_dsp
+import overlap_add
+from synth_server import SynthService
+
+
+service = None  # the SynthService of this process. set before the pool forks, so workers share its pages
+
+
+def read_manifest(path, out_dir):
+    """
+    Read a manifest into a list of (text, output path) jobs, in file order.
+    A .csv manifest needs a header row with a "text" column and optionally a "filename" column, which may include
+    subfolders of out_dir. Any other file is read as plain text with one phrase per line. Phrases without a filename
+    are numbered by their position. Raises ValueError for a .csv without a text column. A filename that could land
+    outside out_dir (an absolute path, or one with .. in it) gets an output path of None, and fails on its own.
+    """
+    jobs = []
+    with open(path, newline="", encoding="utf-8") as manifest:
+        if path.lower().endswith(".csv"):
+            reader = csv.DictReader(manifest)
+            if "text" not in (reader.fieldnames or ()):
+                raise ValueError(path + " needs a header row with a text column, and optionally a filename column.")
+            rows = [(row["text"], row.get("filename")) for row in reader]
+        else:
+            rows = [(line.strip(), None) for line in manifest if line.strip()]
+    for i, (text, filename) in enumerate(rows):
+        filename = filename or "{:06d}.wav".format(i + 1)
+        if os.path.isabs(filename) or os.path.splitdrive(filename)[0] or ".." in re.split(r"[\\/]", filename):
+            jobs.append((text, None))
+        else:
+            jobs.append((text, os.path.join(out_dir, filename)))
+    return jobs
+
+
+def init_worker(service_args, verbose):
+    """Pool initialiser. With fork the parent's service is inherited as-is; otherwise each worker loads its own."""
+    global service
+    if service is None:
+        service = SynthService(*service_args)
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")  # silence the per-phrase progress prints from Utterance and Synth
+
+
+def synthesise_job(job):
+    """Synthesise one (index, text, out_path, crossfade, volume) job and write it. Returns (index, error or None)."""
+    index, text, out_path, crossfade, volume = job
+    try:
+        if out_path is None:
+            raise ValueError("filename expected a relative path inside the output folder, without .. parts")
+        data = service.synthesise(text, crossfade, volume)
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)  # the manifest's filename may name a subfolder
+        audio_interface.write_wav(out_path, data, service.rate)
+    except Exception as e:  # report the failure against its phrase and carry on with the rest of the batch
+        return index, type(e).__name__ + ": " + str(e)
+    return index, None
+
+
+def run_batch(jobs, service_args, crossfade=False, volume=100, processes=None, verbose=False):
+    """
+    Synthesise every (text, out_path) job over a pool of processes. The lexicon and diphone bank are loaded once
+    in this process before the pool starts, so forked workers share them copy-on-write instead of each loading a copy.
+    Results come back in manifest order, so reporting is deterministic. Returns a list of (index, error) failures.
+    """
+    global service
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    if context.get_start_method() == "fork":
+        service = SynthService(*service_args)  # load once, before forking
+
+    tasks = [(i, text, out_path, crossfade, volume) for i, (text, out_path) in enumerate(jobs)]
+    chunksize = max(1, len(tasks) // ((processes or os.cpu_count() or 1) * 8))  # big enough to amortise IPC
+    failures = []
+    with context.Pool(processes, initializer=init_worker, initargs=(service_args, verbose)) as pool:
+        for index, error in pool.imap(synthesise_job, tasks, chunksize):
+            if error is not None:
+                failures.append((index, error))
+    return failures
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Synthesise every phrase in a manifest to its own .wav file.")
+    parser.add_argument('manifest', help="A text file with one phrase per line, or a .csv with text and filename "
+                                         "columns")
+    parser.add_argument('--out-dir', '-o', default="./batch_output", help="Folder to write the .wav files to")
+    parser.add_argument('--processes', '-j', default=None, type=int,
+                        help="Number of worker processes. Default: one per CPU")
+    parser.add_argument('--diphones', default="./diphones", help="Relative path to folder containing diphone .wavs")
+    parser.add_argument('--bank', default="./diphones.bank",
+                        help="Path to a packed diphone bank built by diphone_bank.py. Used instead of --diphones if "
+                             "it exists")
+    parser.add_argument('--lexicon', default=lexicon.LEXICON_PATH,
+                        help="Path to a compiled lexicon built by lexicon.py. NLTK's CMUdict is used if it doesn't "
+                             "exist")
+    parser.add_argument('--crossfade', '-c', action="store_true", default=False,
+                        help="Enable smoother concatenation by cross-fading between diphone units")
+    parser.add_argument('--overlap-ms', default=overlap_add.OVERLAP_MS, type=float,
+                        help="Length in milliseconds of the crossfade between neighbouring diphones")
+    parser.add_argument('--window', default="linear", choices=overlap_add.WINDOWS, help="Shape of the crossfade taper")
+    parser.add_argument('--volume', '-v', default=100, type=int,
+                        help="Integer between 0 and 100, representing final output volume")
+    parser.add_argument('--normalise', default="peak", choices=output_dsp.NORMALISATIONS,
+                        help="Scale the volume by the peak sample, or by the RMS level, for more even loudness "
+                             "between phrases")
+    parser.add_argument('--rate', default=diphone_synth.SAMPLE_RATE, type=int,
+                        help="Sample rate in Hz to write the .wav files at, e.g 8000, 22050 or 48000")
+    parser.add_argument('--verbose', action="store_true", default=False, help="Show per-phrase progress output")
+    args = parser.parse_args()
+
+    if args.overlap_ms < 0:
+        print("--overlap-ms expected a length of 0 or more milliseconds.")
+        quit(0)
+
+    try:
+        batch_jobs = read_manifest(args.manifest, args.out_dir)
+    except ValueError as e:
+        print(e)
+        quit(1)
+    os.makedirs(args.out_dir, exist_ok=True)
+    print("Synthesising", len(batch_jobs), "phrases...")
+
+    start = time.perf_counter()
+    batch_failures = run_batch(batch_jobs, (args.diphones, args.bank, args.overlap_ms, args.window, args.lexicon, None,
+                                            args.rate, args.normalise),
+                               args.crossfade, args.volume, args.processes, args.verbose)
+    elapsed = time.perf_counter() - start
+
+    for failed_index, failure in batch_failures:
+        print("Phrase", failed_index + 1, repr(batch_jobs[failed_index][0]), "failed:", failure)
+    print("Done:", len(batch_jobs) - len(batch_failures), "written,", len(batch_failures), "failed, in",
+          round(elapsed, 2), "s")
+    if batch_failures:
+        quit(1)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# DiphoneSynth
+# Throughput benchmark for normaliser.normalise on megabyte-scale text.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import normaliser
+
+
+# sentences mixing plain words with every kind of token the normaliser expands
+TEMPLATES = (
+    "The meeting on {day}/{month}/{year} starts at {hour}:{minute} and costs ${dollars}.{cents} per person.",
+    "Sales rose {percent}% to {big:,} units in {year}, putting us in {day}th place.",
+    "Please arrive before {hour}:{minute}pm on {day}/{month} and bring £{dollars} for the {day}th lecture.",
+    "She read the long report quietly while the rain kept falling outside the old library windows.",
+    "Chapter {day} covers pages {big} to {bigger} and takes about {percent}.{cents} hours to read.",
+)
+
+
+def make_document(size_bytes, seed=0):
+    """Build a reproducible document of roughly size_bytes of mixed text."""
+    rng = random.Random(seed)
+    sentences = []
+    total = 0
+    while total < size_bytes:
+        sentence = rng.choice(TEMPLATES).format(
+            day=rng.randint(1, 28), month=rng.randint(1, 12), year=rng.randint(1900, 2030),
+            hour=rng.randint(1, 12), minute="{:02d}".format(rng.randint(0, 59)), dollars=rng.randint(1, 999),
+            cents="{:02d}".format(rng.randint(0, 99)), percent=rng.randint(1, 99), big=rng.randint(1000, 10**7),
+            bigger=rng.randint(10**7, 10**9))
+        sentences.append(sentence)
+        total += len(sentence) + 1
+    return " ".join(sentences)
+
+
+def run(size_mb=4, repeats=3):
+    """Time normaliser.normalise over a size_mb document, returning the best of repeats runs as a dict."""
+    document = make_document(int(size_mb * 2**20))
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        normaliser.normalise(document)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return {"input_bytes": len(document), "seconds": best, "mb_per_second": len(document) / 2**20 / best}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure text normalisation throughput on a large document.")
+    parser.add_argument('--size-mb', default=4, type=float, help="Size of the generated document in MB")
+    parser.add_argument('--repeats', default=3, type=int, help="Number of timed runs. The fastest is reported")
+    args = parser.parse_args()
+
+    result = run(args.size_mb, args.repeats)
+    print("Normalised", result["input_bytes"], "bytes in", round(result["seconds"], 3), "s:",
+          round(result["mb_per_second"], 2), "MB/s")
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+# DiphoneSynth
+# Stage-by-stage benchmark of the synthesis pipeline over a synthetic diphone bank, with results saved as JSON.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import os
+import re
+import sys
+import json
+import time
+import wave
+import argparse
+import platform
+import tempfile
+import contextlib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import audio_interface
+import diphone_bank
+import diphone_synth
+import lexicon
+import normaliser
+import output_dsp
+import pitch_marks
+from normaliser_bench import make_document
+
+
+# the inputs every stage is timed over, as their size in bytes of generated text
+INPUT_SIZES = {"short": 80, "medium": 2 * 2**10, "document": 32 * 2**10}
+
+# every stage, in pipeline order
+STAGES = ("tokenise", "get_phone_seq", "get_diphone_ids", "get_wavs", "Audio.load", "make_and_concatenate_chunks",
+          "make_and_concatenate_chunks crossfade", "make_and_concatenate_chunks bank",
+          "make_and_concatenate_chunks bank crossfade", "make_prosody bank", "rescale", "output 22050", "output 48000",
+          "save")
+
+
+def make_diphone_folder(wav_folder, seed=0):
+    """
+    Write a synthetic voice to wav_folder: one .wav per pair of phones (and the pause), named like the real ones,
+    e.g aa-b.wav and pau-k.wav, as 16-bit mono at diphone_synth.SAMPLE_RATE. Each unit is a few harmonics of a random
+    pitch under a smooth envelope, 60 to 150 ms long. The same seed always gives the same voice.
+    """
+    rng = np.random.default_rng(seed)
+    phones = [phone.lower() for phone in lexicon.PHONES + ("PAU",)]
+    os.makedirs(wav_folder, exist_ok=True)
+    for left in phones:
+        for right in phones:
+            length = int(rng.integers(int(0.06 * diphone_synth.SAMPLE_RATE), int(0.15 * diphone_synth.SAMPLE_RATE)))
+            t = np.arange(length) / diphone_synth.SAMPLE_RATE
+            f0 = rng.uniform(90, 180)
+            amplitudes = rng.uniform(0, 1, 5) / np.arange(1, 6)
+            signal = sum(amplitude * np.sin(2 * np.pi * f0 * (k + 1) * t) for k, amplitude in enumerate(amplitudes))
+            signal = signal * np.hanning(length) + rng.normal(0, 0.02, length)
+            samples = (signal / np.max(np.abs(signal)) * 0.3 * audio_interface.MAX_AMP).astype(np.int16)
+
+            wav_file = wave.open(os.path.join(wav_folder, left + "-" + right + ".wav"), "wb")
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(diphone_synth.SAMPLE_RATE)
+            wav_file.writeframes(samples.tobytes())
+            wav_file.close()
+    return len(phones) ** 2
+
+
+def make_inputs(seed=0):
+    """The short, medium and document-length texts, generated the same way every run."""
+    return {name: make_document(size, seed) for name, size in INPUT_SIZES.items()}
+
+
+def make_lexicon(texts):
+    """
+    A lexicon covering every word in texts, with letter-to-sound pronunciations, so the benchmark doesn't need
+    CMUdict and every run pronounces the same words the same way.
+    """
+    words = set()
+    for text in texts:
+        words.update(re.findall(r"[a-z]+", normaliser.normalise(text).lower()))
+    return lexicon.Lexicon.from_phone_dict({word: [list(lexicon.letter_to_sound(word))] for word in words})
+
+
+def best_time(function, repeats):
+    """Run function repeats times and return (fastest time in seconds, result of the last run)."""
+    timings = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def tokenised(text, phone_lexicon):
+    utt = diphone_synth.Utterance(text, phone_lexicon)
+    utt.tokenise()
+    return utt
+
+
+def load_all(wav_paths):
+    # decode from the file every time, rather than timing the unit cache
+    for path in wav_paths:
+        audio_interface.Audio(rate=diphone_synth.SAMPLE_RATE).load(path, cache=False)
+
+
+def save(data, path):
+    output = audio_interface.Audio(rate=diphone_synth.SAMPLE_RATE)
+    output.data = data
+    output.save(path)
+
+
+def bench_input(text, phone_lexicon, folder_synth, bank_synth, out_path, repeats):
+    """Time every stage in STAGES over one text. Returns ({stage: seconds}, description of the input)."""
+    seconds = {}
+    seconds["tokenise"], utt = best_time(lambda: tokenised(text, phone_lexicon), repeats)
+    seconds["get_phone_seq"], _ = best_time(utt.get_phone_seq, repeats)
+    seconds["get_diphone_ids"], diphone_ids = best_time(utt.get_diphone_ids, repeats)
+    seconds["get_wavs"], wavs = best_time(lambda: folder_synth.get_wavs(diphone_ids), repeats)
+    wav_paths = [wav for wav in wavs if wav not in folder_synth.silences]
+    seconds["Audio.load"], _ = best_time(lambda: load_all(wav_paths), repeats)
+
+    for name, synth in (("", folder_synth), (" bank", bank_synth)):
+        stage = "make_and_concatenate_chunks" + name
+        seconds[stage], data = best_time(lambda: synth.make_and_concatenate_chunks(diphone_ids), repeats)
+        seconds[stage + " crossfade"], _ = best_time(lambda: synth.make_and_concatenate_chunks(diphone_ids, True),
+                                                     repeats)
+    # TD-PSOLA to a flat pitch and 20% slower, from the pitch marks built with the bank
+    seconds["make_prosody bank"], _ = best_time(
+        lambda: bank_synth.make_prosody(diphone_ids, f0=120, duration_scale=1.2), repeats)
+
+    seconds["rescale"], data = best_time(lambda: audio_interface.rescale(data, 0.8), repeats)
+    for rate in (22050, 48000):  # resampled to common device rates, on a warm output stage as in a long-running synth
+        stage = output_dsp.OutputStage(diphone_synth.SAMPLE_RATE, rate)
+        seconds["output " + str(rate)], _ = best_time(lambda: stage.process(data, 80), repeats)
+    seconds["save"], _ = best_time(lambda: save(data, out_path), repeats)
+
+    description = {"bytes": len(text.encode("utf-8")), "tokens": len(utt.final_tokenisation),
+                   "diphones": len(diphone_ids), "samples": len(data),
+                   "audio_seconds": len(data) / diphone_synth.SAMPLE_RATE}
+    return seconds, description
+
+
+def run(repeats=5, seed=0, work_dir=None, lexicon_path=None, verbose=False):
+    """
+    Build the synthetic voice in work_dir (a temporary folder by default) and time every stage over every input.
+    lexicon_path is a compiled lexicon to use instead of the generated one. Returns the results as a dict.
+    """
+    with contextlib.ExitStack() as stack:
+        if work_dir is None:
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        wav_folder = os.path.join(work_dir, "diphones")
+        bank_path = os.path.join(work_dir, "diphones.bank")
+        units = make_diphone_folder(wav_folder, seed)
+        diphone_bank.compile_bank(wav_folder, bank_path)
+        pitch_marks.compile_marks(diphone_bank.DiphoneBank(bank_path))
+
+        texts = make_inputs(seed)
+        phone_lexicon = lexicon.Lexicon.load(lexicon_path) if lexicon_path else make_lexicon(texts.values())
+        folder_synth = diphone_synth.Synth(None, wav_folder=wav_folder)
+        bank_synth = diphone_synth.Synth(diphone_bank.DiphoneBank(bank_path))
+
+        results = {}
+        inputs = {}
+        if not verbose:  # the pipeline's progress prints would be timed too, and swamp the output
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        for name, text in texts.items():
+            results[name], inputs[name] = bench_input(text, phone_lexicon, folder_synth, bank_synth,
+                                                      os.path.join(work_dir, "out.wav"), repeats)
+
+    return {"meta": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                     "repeats": repeats, "seed": seed, "units": units, "sample_rate": diphone_synth.SAMPLE_RATE,
+                     "lexicon": lexicon_path or "letter-to-sound"},
+            "inputs": inputs, "seconds": results}
+
+
+def compare(result, baseline):
+    """Print each stage's time against a baseline result, as a ratio (above 1 is slower than the baseline)."""
+    for name, stages in result["seconds"].items():
+        for stage in STAGES:
+            old = baseline["seconds"].get(name, {}).get(stage)
+            new = stages[stage]
+            ratio = "{:.2f}x".format(new / old) if old else "new"
+            print("{:<9} {:<44} {:>10.3f} ms  {:>7}".format(name, stage, new * 1000, ratio))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time each stage of the synthesis pipeline over a synthetic voice.")
+    parser.add_argument('--repeats', default=5, type=int,
+                        help="Number of timed runs per stage. The fastest is reported")
+    parser.add_argument('--seed', default=0, type=int, help="Seed for the generated voice and texts")
+    parser.add_argument('--work-dir', default=None, help="Folder to build the synthetic voice in. Default: a temporary "
+                                                         "folder")
+    parser.add_argument('--lexicon', default=None, help="A compiled lexicon to use instead of letter-to-sound")
+    parser.add_argument('--output', '-o', default="pipeline_bench.json", help="JSON file to write the results to")
+    parser.add_argument('--compare', default=None, help="JSON results of an earlier run to compare against")
+    parser.add_argument('--verbose', action="store_true", default=False, help="Show the pipeline's progress output")
+    args = parser.parse_args()
+
+    bench = run(args.repeats, args.seed, args.work_dir, args.lexicon, args.verbose)
+    with open(args.output, "w") as output_file:
+        json.dump(bench, output_file, indent=2)
+
+    baseline_result = {"seconds": {}}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline_result = json.load(baseline_file)
+    compare(bench, baseline_result)
+    print("Results written to", args.output)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# DiphoneSynth
+# Cold start benchmark: import time of diphone_synth and latency of the first utterance, against a budget.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# the budget, in milliseconds, measured from the first line of a fresh interpreter. the run fails if it's exceeded
+IMPORT_BUDGET_MS = 250
+FIRST_UTTERANCE_BUDGET_MS = 1000
+
+# modules that should only ever be imported when they're needed
+LAZY_MODULES = ("nltk", "pyaudio")
+
+# run in a fresh interpreter for every measurement, so nothing is already imported or cached
+CHILD = """
+import sys, time, json
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+import diphone_synth
+imported = time.perf_counter()
+lazy = [name for name in {lazy!r} if name in sys.modules]
+diphone_synth.synthesise({text!r}, diphones={diphones!r}, bank={bank!r}, lexicon_path={lexicon!r}, save={save!r})
+done = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - start) * 1000, "first_utterance_ms": (done - start) * 1000,
+                  "imported_on_import": lazy, "portaudio": "pyaudio" in sys.modules}}))
+"""
+
+
+def measure(text, diphones, bank, lexicon_path):
+    """Time one cold start in a new process, returning its measurements as a dict."""
+    with tempfile.TemporaryDirectory() as out_dir:
+        code = CHILD.format(root=os.path.abspath(ROOT), lazy=LAZY_MODULES, text=text, diphones=diphones, bank=bank,
+                            lexicon=lexicon_path, save=os.path.join(out_dir, "first.wav"))
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])  # the last line, after the synthesiser's progress prints
+
+
+def run(text="Hello world.", repeats=5, diphones="./diphones", bank="./diphones.bank",
+        lexicon_path="./cmudict.lex"):
+    """Measure repeats cold starts, returning the fastest import and first utterance times and the budgets as a dict."""
+    results = [measure(text, diphones, bank, lexicon_path) for _ in range(repeats)]
+    return {"import_ms": min(result["import_ms"] for result in results),
+            "first_utterance_ms": min(result["first_utterance_ms"] for result in results),
+            "import_budget_ms": IMPORT_BUDGET_MS, "first_utterance_budget_ms": FIRST_UTTERANCE_BUDGET_MS,
+            "imported_on_import": results[0]["imported_on_import"], "portaudio": results[0]["portaudio"]}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure cold start latency against the import and first utterance "
+                                                 "budgets.")
+    parser.add_argument('--text', default="Hello world.", help="The first utterance to synthesise")
+    parser.add_argument('--repeats', default=5, type=int, help="Number of cold starts. The fastest is reported")
+    parser.add_argument('--diphones', default="./diphones", help="Relative path to folder containing diphone .wavs")
+    parser.add_argument('--bank', default="./diphones.bank", help="Path to a packed diphone bank")
+    parser.add_argument('--lexicon', default="./cmudict.lex", help="Path to a compiled lexicon")
+    parser.add_argument('--json', action="store_true", default=False, help="Print the results as JSON, for tracking")
+    args = parser.parse_args()
+
+    result = run(args.text, args.repeats, args.diphones, args.bank, args.lexicon)
+    problems = []
+    if result["import_ms"] > IMPORT_BUDGET_MS:
+        problems.append("import is over budget")
+    if result["first_utterance_ms"] > FIRST_UTTERANCE_BUDGET_MS:
+        problems.append("first utterance is over budget")
+    if result["imported_on_import"]:
+        problems.append("importing diphone_synth imported " + ", ".join(result["imported_on_import"]))
+    if result["portaudio"]:
+        problems.append("a save-only run imported PyAudio")
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print("Import:", round(result["import_ms"], 1), "ms (budget", IMPORT_BUDGET_MS, "ms)")
+        print("First utterance:", round(result["first_utterance_ms"], 1), "ms (budget",
+              FIRST_UTTERANCE_BUDGET_MS, "ms)")
+    for problem in problems:
+        print("Failed:", problem)
+    if problems:
+        quit(1)
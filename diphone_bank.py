@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# DiphoneSynth
+# Packed diphone bank: every diphone .wav in one contiguous int16 file, plus a name -> (offset, length, rate) index.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import os
+import json
+import hashlib
+import wave
+import argparse
+import numpy as np
+import pitch_marks
+
+
+BANK_DTYPE = np.int16  # the packed bank only holds 16-bit mono data, like the .wavs in ./diphones
+INDEX_SUFFIX = ".json"  # the index lives next to the bank, e.g diphones.bank + diphones.bank.json
+
+
+def compile_bank(wav_folder, bank_path):
+    """
+    One-time "compile bank" step. Walk wav_folder once, append the samples of every .wav to a single raw int16 file
+    at bank_path, and write an index mapping each diphone name (the filename without .wav, e.g "aa-b") to its
+    (offset, length, sample_rate) in samples, along with a digest of the packed samples, so the bank's version
+    changes when any audio does, even a unit re-recorded at the same length. Returns the index.
+    """
+
+    wav_paths = []
+    for root, dirs, files in os.walk(wav_folder, topdown=False):
+        for file in files:
+            if file.lower().endswith(".wav"):
+                wav_paths.append(os.path.join(root, file))
+    wav_paths.sort()  # keep the packed layout deterministic between builds
+
+    index = {}
+    offset = 0
+    digest = hashlib.sha1()
+    with open(bank_path, "wb") as bank_file:
+        for path in wav_paths:
+            wave_file = wave.open(path, "rb")
+            if wave_file.getsampwidth() != 2 or wave_file.getnchannels() != 1:
+                print("Skipping", path, ": only 16-bit mono .wavs can be packed.")
+                wave_file.close()
+                continue
+            sample_rate = wave_file.getframerate()
+            raw_data = wave_file.readframes(wave_file.getnframes())  # one bulk read per file
+            wave_file.close()
+
+            length = len(raw_data) // 2
+            bank_file.write(raw_data)
+            digest.update(raw_data)
+            name = os.path.basename(path)[:-4].lower()
+            index[name] = (offset, length, sample_rate)
+            offset += length
+
+    with open(bank_path + INDEX_SUFFIX, "w") as index_file:
+        json.dump({"dtype": np.dtype(BANK_DTYPE).str, "samples_sha1": digest.hexdigest(), "units": index}, index_file)
+
+    return index
+
+
+class DiphoneBank:
+    """
+    A compiled diphone bank, memory-mapped read-only. Each unit is handed out as a zero-copy NumPy view into the
+    mapping, so looking up a diphone is a single dict access and no file is opened per request.
+    Primarily, use bank[name] or bank.get(name), where name is a diphone name such as "aa-b" (case-insensitive),
+                   name in bank, to check a diphone exists.
+    """
+
+    def __init__(self, bank_path):
+        self.bank_path = bank_path
+        with open(bank_path + INDEX_SUFFIX, "rb") as index_file:
+            index_bytes = index_file.read()
+        header = json.loads(index_bytes)
+        # changes whenever the bank is rebuilt differently, samples included, as the index holds their digest
+        self.version = hashlib.sha1(index_bytes).hexdigest()
+        self.dtype = np.dtype(header["dtype"])
+        self.index = {name: tuple(entry) for name, entry in header["units"].items()}
+        # the same index as arrays, so units can also be addressed by number, e.g from a phone pair lookup table
+        self.names = list(self.index)
+        self.offsets = np.array([self.index[name][0] for name in self.names], dtype=np.int64)
+        self.lengths = np.array([self.index[name][1] for name in self.names], dtype=np.int64)
+        # np.memmap refuses zero-length files, so an empty bank is just an empty array
+        if os.path.getsize(bank_path):
+            self.samples = np.memmap(bank_path, dtype=self.dtype, mode="r")
+        else:
+            self.samples = np.array([], dtype=self.dtype)
+
+    def __contains__(self, name):
+        return name.lower() in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, name):
+        offset, length, sample_rate = self.index[name.lower()]
+        return self.samples[offset:offset + length]  # basic slicing of a memmap is a view, not a copy
+
+    def unit(self, unit_id):
+        """Return the samples of the unit at position unit_id in self.names."""
+        offset = self.offsets[unit_id]
+        return self.samples[offset:offset + self.lengths[unit_id]]
+
+    def get(self, name, default=None):
+        """Return the samples for a diphone, or default if the bank doesn't contain it."""
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def sample_rate(self, name):
+        """Return the sample rate a diphone was recorded at."""
+        return self.index[name.lower()][2]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Pack a folder of diphone .wavs into a memory-mappable bank.")
+    parser.add_argument('--diphones', default="./diphones", help="Relative path to folder containing diphone .wavs")
+    parser.add_argument('--bank', default="./diphones.bank", help="Path of the packed bank file to write")
+    parser.add_argument('--no-marks', action="store_false", dest="marks",
+                        help="Don't detect the pitch marks of the diphones, which prosody control (--psola) needs")
+    args = parser.parse_args()
+
+    units = compile_bank(args.diphones, args.bank)
+    print("Packed", len(units), "diphones into", args.bank)
+    if args.marks:
+        marks = pitch_marks.compile_marks(DiphoneBank(args.bank))
+        print("Found", marks, "pitch marks, written to", args.bank + pitch_marks.MARKS_SUFFIX)
@@ -6,346 +6,587 @@
 # License: GNU GPL v3
 
 import os
+import time
+import hashlib
+import threading
 import audio_interface
+import diphone_bank
+import instrumentation
+import lexicon
+import normaliser
+import output_dsp
+import overlap_add
+import pitch_marks
+import psola
 import argparse
-import nltk
-from nltk.corpus import cmudict
-import re
 import numpy as np
 
 
 SAMPLE_RATE = 16000  # the sample rate of .wav files in ./diphones.
 
 
-parser = argparse.ArgumentParser(
-    description='A basic object oriented text-to-speech program using diphone speech synthesis.')
-parser.add_argument('--diphones', default="./diphones", help="Relative path to folder containing diphone .wavs")
-parser.add_argument('--play', '-p', action="store_true", default=True, help="Play the processed audio data")
-parser.add_argument('--save', '-s', action="store", dest="outfile", type=str, help="Save the audio output to a file",
-                    default=None)
-parser.add_argument('phrase', nargs=1, help="The phrase to be synthesised")
-parser.add_argument('--crossfade', '-c', action="store_true", default=False,
-                    help="Enable smoother concatenation by cross-fading between diphone units, i.e TD-PSOLA")
-parser.add_argument('--volume', '-v', default=100, type=int,
-                    help="Integer between 0 and 100, representing final output volume")
-#parser.add_argument('--help', '-h', help="Shows help menu.")
-args = parser.parse_args()
-
-# regex to match DD/MM/YY or DD/MM/YYYY, can also match . or - separators
-dmy_reg = re.compile(r"""
-       (?P<day>^0?[1-9]|[12][0-9]|3[01])       # group as "day" all matches between 1 and 31 at the start of the string
-       [/.-]                                   # match / . or - (don't group)
-       (?P<month>[1-9]|1[012])                 # group as "month" all matches between 1 and 12
-       [/.-]                                   
-       (?P<year>(?:\d{4}|\d{2})$)              # group as "year" any 2 or 4 digit number at end of the string
-       """, re.VERBOSE)
-# regex to match DD/MM, can also match . or - separators
-dm_reg = re.compile(r"""
-       (?P<day>^0?[1-9]|[12][0-9]|3[01])       # group as "day" all matches between 1 and 31 at the start of the string
-       [/.-]                                   # match / . or - (don't group)
-       (?P<month>[1-9]|1[012])$                # group as "month" all matches between 1 and 12 at the end of the string
-       """, re.VERBOSE)
-
-
-
 class Utterance:
     """
-    The Utterance object: the frontend of the TTS system. Here we tokenise the user's input, normalise dates into
-    speakable words, and build a sequence of diphones.
-
-    Much extension opportunity for this class. Can normalise many more types of numbers: e.g monetary values, numbers alone,
-    time, percentages etc. As is, the synthesiser will fail to process these tokens.
+    The Utterance object: the frontend of the TTS system. Here we normalise numbers, dates, times, money and
+    percentages in the user's input into speakable words, tokenise it, and build a sequence of diphones.
     """
-    def __init__(self, phrase):
+    def __init__(self, phrase, lexicon=None):
         self.final_tokenisation = list()
-        self.diphone_sequence = list()
+        self.diphone_sequence = None  # set by get_diphone_ids
         self.utterance_phrase = phrase      # args.phrase[0]
+        self.lexicon = lexicon              # a lexicon.Lexicon. the shared default lexicon is used if None
+        self.metrics = instrumentation.metrics  # where stage timings and counts go, see instrumentation.Metrics
 
     def tokenise(self):
         """
-        Simple first tokenisation. Using NLTK's standard tokeniser, build a list of the words in the utterance.
-        Any tokens that match the date regexes are passed to normalise_dates to be expanded into words themselves,
-        and are returned to this method to be added to the final list of tokens.
+        Simple first tokenisation. The phrase is first passed through normaliser.normalise, which expands numbers,
+        dates, times etc. into words in a single pass. Then, using NLTK's standard tokeniser, build a list of the
+        words in the utterance. Errors, e.g a missing NLTK or punkt, are raised to the caller.
         """
 
-        phrase_tokenised = nltk.word_tokenize(self.utterance_phrase)
+        import nltk  # imported here, on first use, as it is by far the slowest import
+        with self.metrics.stage("tokenise") as stage:
+            phrase_normalised = normaliser.normalise(self.utterance_phrase)
+            self.final_tokenisation += nltk.word_tokenize(phrase_normalised)
+            stage.fields["tokens"] = len(self.final_tokenisation)
 
-        try:
-            for token in phrase_tokenised:
-                if re.match(dmy_reg, token) is not None \
-                        or re.match(dm_reg, token) is not None:      # if the token corresponds to regex above,
-                    expanded_date = self.normalise_dates(token)      # pass the current token to date normalisation
-                    self.final_tokenisation += expanded_date.copy()  # and add it to the final list
-                else:
-                    self.final_tokenisation.append(token)            # if there is no regex match, use original token
-
-            print("Tokens:", self.final_tokenisation)
-
-        except Exception as e:
-            print(e)  # since most errors here will be caused by incorrect/missing args, just print any error.
-            print("Please make sure you are using arguments as specified in --help or the readme.")
+        print("Tokens:", self.final_tokenisation)
 
     def normalise_dates(self, token):
         """      ---      DATE EXPANSION      ---
         This module takes a token in the format DD/MM, DD/MM/YY, or DD/MM/YYYY. It returns this as a list of strings
-        such as "June Twenty Eighth, Nineteen Fourteen".
-
-        This function could be extended as "normalise_numbers", handling dates and other values in phrase input such
-        as integers (up to trillion?), monetary values, times, mathematical expressions etc, because CMU dictionary
-        does not contain non-word characters.
+        such as "twenty eighth june , nineteen fourteen". Dates are now expanded along with every other kind of
+        number by normaliser.normalise, which tokenise runs over the whole phrase.
         """
+        return normaliser.normalise(token).split()
 
-        # set up tuples with names. naturally, integer input will be used as index to find the corresponding word.
-        # index 0 is set as some placeholder value in day_names and month_names
-        day_names = ("Zeroth", "First", "Second", "Third", "Fourth", "Fifth", "Sixth", "Seventh", "Eighth", "Ninth",
-                     "Tenth", "Eleventh,", "Twelfth", "Thirteenth", "Fourteenth", "Fifteenth", "Sixteenth",
-                     "Seventeenth", "Eighteenth", "Nineteenth", "Twentieth", "Thirtieth", "Twenty", "Thirty")
-
-        month_names = ("N/Anuary", "January", "February", "March", "April", "May", "June", "July",
-                       "August", "September", "October", "November", "December")
-
-        under_twenty = ('Oh', 'One', 'Two', 'Three', 'Four', 'Five', 'Six', 'Seven', 'Eight', 'Nine', 'Ten', 'Eleven',
-                    'Twelve', 'Thirteen', 'Fourteen', 'Fifteen', 'Sixteen', 'Seventeen', 'Eighteen', 'Nineteen')
-
-        tens = ('Twenty', 'Thirty', 'Forty', 'Fifty', 'Sixty', 'Seventy', 'Eighty', 'Ninety')
-
-        result_date = []
-
-        # begin tedious expansion of date tokens
-        date_matcher = dmy_reg.match(token)
-        if date_matcher:
-            if 0 < int(date_matcher.group(1)) < 20:  # handle days
-                result_date.append(day_names[int(date_matcher.group(1))])
-            elif int(date_matcher.group(1)) == 20:
-                result_date.append(day_names[20])
-            elif 20 < int(date_matcher.group(1)) < 30:
-                result_date.append(day_names[22])
-                result_date.append(day_names[int(date_matcher.group(1)) % 10])
-            elif int(date_matcher.group(1)) == 30:
-                result_date.append(day_names[21])
-            else:
-                result_date.append(day_names[23])
-                result_date.append(day_names[1])
-
-            result_date.append(month_names[int(date_matcher.group(2))])  # handle month
-            result_date.append(",")
-
-            # with the following code, only years from 1000 to 2099 are supported
-            if 1000 <= int(date_matcher.group(3)) <= 1999:
-                result_date.append(under_twenty[int(date_matcher.group(3))[:1]])  # take only the millennium and century
-            elif 2000 <= int(date_matcher.group(3)) <= 2099:
-                result_date.append(tens[0])
-
-            year = int(date_matcher.group(3)) % 100  # get last two digits of year
-
-            if 1 <= year < 10:  # handle first decade separately
-                result_date.append(under_twenty[0])
-                result_date.append(under_twenty[year])
-            elif 10 <= year < 20:  # handle teens
-                result_date.append(under_twenty[year])
-            elif 20 <= year <= 99:  # handle rest of the decades...
-                ten, under_ten = divmod(year, 10)  # get quotient and remainder to use
-                result_date.append(tens[ten - 2])  # as indices for getting name from 20 to 99
-                result_date.append(under_twenty[under_ten]) 
-            else:
-                print("Invalid year.")  # this shouldn't happen
-
-            # clean up trailing "Oh"
-            if result_date[-1] == "Oh":
-                result_date.pop(-1)
-
-        date_matcher = dm_reg.match(token)  # now, for handling DD/MM cases. This is largely repeated from above,
-        if date_matcher:                    # so check if we might optimise this a bit.
-
-            if int(date_matcher.group(1)) < 20:  # handle days
-                result_date.append(day_names[int(date_matcher.group(1))])
-            elif int(date_matcher.group(1)) == 20:
-                result_date.append(day_names[20])
-            elif 20 < int(date_matcher.group(1)) < 30:
-                result_date.append(day_names[22])
-                result_date.append(day_names[int(date_matcher.group(1)) % 10])
-            elif int(date_matcher.group(1)) == 30:
-                result_date.append(day_names[21])
-            else:
-                result_date.append(day_names[23])
-                result_date.append(day_names[1])
-
-            result_date.append(month_names[int(date_matcher.group(2))])  # handle month
-
-        return result_date
-
-    def get_phone_seq(self):
+    def get_diphone_ids(self):
         """---      LETTER TO SOUND      ---
-        This module creates a diphone sequence from the tokenised phrase by first looking up each word token in the CMU
-        phones dictionary, and then joining pairs of these into diphones. It also replaces punctuation with appropriate
-        lengths of silence.
+        This module creates a diphone sequence from the tokenised phrase by first looking up each word token in the
+        lexicon, and then joining pairs of these into diphones. It also replaces punctuation with appropriate lengths
+        of silence. The sequence is returned as an (n, 2) array of IDs into lexicon.INVENTORY, one row per diphone,
+        with silences as a pair of the same silence marker, ready for Synth to resolve with one table lookup.
         """
 
         print("Processing diphones...")
 
-        # define punctuation types; all, short, and long. first tuple may seem redundant, but it makes later code
-        # a bit more efficient, and also enables proper functioning of punctuation-to-silence replacement.
-        punctuation = ("\\", "/", ",", ":", ";", "—", "(", ")", "[", "]", "{", "}", "\"", "?", "!", ".", "...")
+        start = time.perf_counter()  # for the "diphones" stage, recorded at the end
+        # define punctuation types; short and long. each is replaced by the marker of its silence in the phone list.
         punctuation_short = ("\\", "/", ",", ":", ";", "—", "(", ")", "[", "]", "{", "}", "\"")
         punctuation_long = ("?", "!", ".", "...")
+        silences = dict.fromkeys(punctuation_short, lexicon.SILENCE_SHORT)
+        silences.update(dict.fromkeys(punctuation_long, lexicon.SILENCE_LONG))
 
-        phone_dict = cmudict.dict()
-        phones_list = ['PAU']  # start with a phrase-initial pause
+        phone_lexicon = self.lexicon if self.lexicon is not None else lexicon.load_lexicon()
+        phones_list = [lexicon.PAU]  # start with a phrase-initial pause
         for token in self.final_tokenisation:
-            if token in punctuation:
-                phones_list.append(token)  # punctuation has no phone, so add as-is.
+            if token in silences:
+                phones_list.append(silences[token])  # punctuation has no phone, so add its silence marker.
             else:
-                try:
-                    phones_list += phone_dict.get(token.lower())[:1].copy()[0]  # add the token's phones to the list
-                except TypeError:
-                    print("Error:", token, "is not in the CMU dictionary. Try changing it to a word.")
-                    quit(0)  # catch exception in case of unrecognised token (including numerals)
-
-        phones_list.append('PAU')  # end with a phrase-final pause
-
-        # now format the raw phone list into a list of diphones we can work with
-        # re.sub is used to remove unwanted numbers from the phone name.
-        # basically, the following algorithm takes the name of the current phone and adds the name of the next phone,
-        # with a hyphen, corresponding to the filenames in ./diphones.
-        diphone_sequence = []
-        for i, elem in enumerate(phones_list):
-            nextelem = phones_list[(i + 1) % len(phones_list)]  # define next element in the list
-            previouselem = phones_list[(i - 1)]  # define previous element in the list
-
-            if previouselem in punctuation:  # put a pause after punctuation, for smooth transition from it
-                diphone_sequence.append("PAU-" + re.sub(r'\d+', '', elem))
-            if nextelem in punctuation:  # put a pause before punctuation, for smooth transition into it
-                diphone_sequence.append(re.sub(r'\d+', '', elem) + "-PAU")
-            elif elem not in punctuation and nextelem not in punctuation:  # otherwise just make the diphone
-                diphone_sequence.append(re.sub(r'\d+', '', elem) + "-" + re.sub(r'\d+', '', nextelem))
-
-            if elem in punctuation:  # now replace punctuation with markers for silences of appropriate length
-                if elem in punctuation_long:
-                    diphone_sequence.append("400ms-silence")
-                elif elem in punctuation_short:
-                    diphone_sequence.append("200ms-silence")
-
-        return diphone_sequence
+                # words missing from the dictionary get a letter-to-sound guess instead of stopping the synthesis
+                token_phones = phone_lexicon.pronounce_ids(token)
+                if not token_phones:
+                    print("Token", token, "can't be pronounced. Skipping...")
+                    self.metrics.count("tokens_unpronounceable")
+                phones_list += token_phones  # add the token's phone IDs to the list
+
+        phones_list.append(lexicon.PAU)  # end with a phrase-final pause
+
+        # now join the phone list into diphones, all at once. every phone can give up to three diphones, in this order:
+        # a pause after punctuation, for smooth transition from it; then either a pause before punctuation, for
+        # smooth transition into it, or otherwise just the diphone with the next phone; and if the phone is itself
+        # punctuation, its silence. like the old name-based loop, the neighbours of the ends wrap around.
+        phones = np.array(phones_list, dtype=np.int32)
+        following = np.roll(phones, -1)
+        is_silence = phones >= lexicon.SILENCE_SHORT
+        previous_silence, next_silence = np.roll(is_silence, 1), np.roll(is_silence, -1)
+        pause = np.full_like(phones, lexicon.PAU)
+
+        slots = np.empty((len(phones), 3, 2), dtype=np.int32)
+        slots[:, 0, 0], slots[:, 0, 1] = pause, phones
+        slots[:, 1, 0], slots[:, 1, 1] = phones, np.where(next_silence, pause, following)
+        slots[:, 2, 0], slots[:, 2, 1] = phones, phones
+        valid = np.stack([previous_silence, next_silence | ~is_silence, is_silence], axis=1)
+
+        self.diphone_sequence = slots[valid]
+        self.metrics.record("diphones", time.perf_counter() - start, diphones=len(self.diphone_sequence))
+        return self.diphone_sequence
+
+    def get_phone_seq(self):
+        """
+        The same diphone sequence as get_diphone_ids, as a list of diphone names such as "PAU-HH", "HH-AH" or
+        "200ms-silence".
+        """
+        diphone_names = []
+        for left, right in self.get_diphone_ids():
+            if left == right and left >= lexicon.SILENCE_SHORT:
+                diphone_names.append(lexicon.INVENTORY[left])
+            else:
+                diphone_names.append(lexicon.INVENTORY[left] + "-" + lexicon.INVENTORY[right])
+        return diphone_names
 
 
 class Synth:
     """
-    Get the output of Utterance.get_phone_seq() (a list of diphones), get the corresponding filenames of each diphone, 
-    put the appropriate length of silences, make a temporary audio processing object to help in concatenating all the
-    audio data of each diphone.
+    Get the output of Utterance.get_diphone_ids() (an array of phone ID pairs), look up the diphone unit for each pair
+    in a precomputed table, put the appropriate length of silences, and concatenate the audio data of each diphone.
+    The older list of diphone names from Utterance.get_phone_seq() is accepted too.
     """
 
-    def __init__(self):
+    def __init__(self, bank=None, overlap_ms=overlap_add.OVERLAP_MS, window="linear", wav_folder="./diphones",
+                 cache=None):
         self.diphones = {}
+        self.bank = bank  # a diphone_bank.DiphoneBank, or None to load .wavs from the diphone folder
+        self.cache = cache  # a synth_cache.SynthCache to reuse the audio of repeated phrases, or None
+        self.wav_folder = wav_folder
+        self.wav_list = None  # names of the .wavs in wav_folder, scanned once on first use
+        self.folder_version = None  # digest of the name, size and mtime of every file in wav_folder, from load_units
+        self.unit_names = None  # unit ID -> diphone name, built once on first use by load_units
+        self.unit_ids = None  # diphone name -> unit ID
+        self.unit_table = None  # (left phone ID, right phone ID) -> unit ID, or -1 if there's no such diphone
+        self.crossfader = overlap_add.OverlapAdd(SAMPLE_RATE, overlap_ms, window)  # windows are precomputed here
+        self.psola = psola.Psola(SAMPLE_RATE)
+        self.pitch_marks = None  # the bank's pitch_marks.PitchMarks, loaded on first use by make_prosody
+        self.metrics = instrumentation.metrics  # where stage timings and counts go, see instrumentation.Metrics
 
-    def get_wavs(self, wav_folder=args.diphones):
-        """Convert the joined diphone list into a list of .wav filenames that can later be loaded as audio."""
-
-        # make a set of existing diphone names to check against, so we don't get errors down the line
-        wav_list = set([])
-        for root, dirs, files in os.walk(wav_folder, topdown=False):
-            for file in files:
-                wav_list.add(file)
-
-        phone_sequence = utt.get_phone_seq()  # get the sequence of phones in user's phrase
+        # define silences as an ndarray of some length of zeroes
+        self.silences = {"200ms-silence": np.zeros(int(SAMPLE_RATE * 0.2), np.int16),
+                         "400ms-silence": np.zeros(int(SAMPLE_RATE * 0.4), np.int16)}
 
-        # build the actual filenames based on the diphone list from get_phone_seq
-        wavs_for_concatenation = []
-        for diphone in phone_sequence:  # still need to include silences, since they will be replaced by zeroes later
-            if diphone == "200ms-silence" or diphone == "400ms-silence":
-                wavs_for_concatenation.append(diphone)
-            elif (diphone.lower() + ".wav") in wav_list:
-                wavs_for_concatenation.append(args.diphones + "/" + diphone.lower() + ".wav")  # make diphone filenames
+    def load_units(self):
+        """
+        Number every available diphone, with the two silences as the last two units, and build the 2-D table from
+        phone ID pairs to unit IDs. With a packed bank, unit IDs are the bank's own unit numbers. Without one, the
+        folder's version is taken from the files seen here, since editing a .wav doesn't change the folder's mtime.
+        """
+        if self.bank is not None:
+            names = list(self.bank.names)
+        else:
+            # make a set of existing diphone names to check against, so we don't get errors down the line
+            if self.wav_list is None:
+                wav_list = set([])
+                entries = []
+                for root, dirs, files in os.walk(self.wav_folder, topdown=False):
+                    for file in files:
+                        wav_list.add(file)
+                        stat = os.stat(os.path.join(root, file))
+                        entries.append(os.path.join(root, file) + ":" + str(stat.st_size) + ":" + str(stat.st_mtime_ns))
+                self.wav_list = wav_list
+                self.folder_version = hashlib.sha1("\n".join(sorted(entries)).encode("utf-8")).hexdigest()
+            names = sorted(file[:-4].lower() for file in self.wav_list if file.lower().endswith(".wav"))
+        names += ["200ms-silence", "400ms-silence"]
+
+        unit_ids = {name: i for i, name in enumerate(names)}
+        phone_ids = {phone.lower(): i for i, phone in enumerate(lexicon.INVENTORY)}
+        unit_table = np.full((len(lexicon.INVENTORY), len(lexicon.INVENTORY)), -1, dtype=np.int32)
+        for name, unit_id in unit_ids.items():
+            left, _, right = name.partition("-")
+            if left in phone_ids and right in phone_ids:  # units outside the inventory are only reachable by name
+                unit_table[phone_ids[left], phone_ids[right]] = unit_id
+        # silences are encoded as a pair of the same silence marker
+        unit_table[lexicon.SILENCE_SHORT, lexicon.SILENCE_SHORT] = unit_ids["200ms-silence"]
+        unit_table[lexicon.SILENCE_LONG, lexicon.SILENCE_LONG] = unit_ids["400ms-silence"]
+
+        self.unit_names, self.unit_ids, self.unit_table = names, unit_ids, unit_table
+
+    def get_units(self, phone_sequence):
+        """
+        Resolve a diphone sequence to an array of unit IDs. An array of phone ID pairs from Utterance.get_diphone_ids()
+        is resolved with a single NumPy indexing operation; a list of names from Utterance.get_phone_seq() is
+        looked up name by name. Missing diphones are reported and skipped.
+        """
+        with self.metrics.stage("resolve_units") as stage:
+            units = self.resolve_units(phone_sequence)
+            stage.fields["units"] = len(units)
+        self.metrics.count("units_resolved", len(units))
+        self.metrics.count("units_missing", len(phone_sequence) - len(units))
+        return units
+
+    def resolve_units(self, phone_sequence):
+        """The lookup behind get_units, without the instrumentation."""
+        if self.unit_table is None:
+            self.load_units()
+        source = self.bank.bank_path if self.bank is not None else self.wav_folder
+
+        if isinstance(phone_sequence, np.ndarray):
+            phone_sequence = phone_sequence.reshape(-1, 2)
+            units = self.unit_table[phone_sequence[:, 0], phone_sequence[:, 1]]
+            missing = units < 0
+            if missing.any():
+                for left, right in phone_sequence[missing]:
+                    print("Diphone", lexicon.INVENTORY[left] + "-" + lexicon.INVENTORY[right], "not found in", source,
+                          ". Skipping...")
+                units = units[~missing]
+            return units
+
+        units = []
+        for diphone in phone_sequence:
+            unit_id = self.unit_ids.get(diphone.lower())
+            if unit_id is None:
+                print("Diphone", diphone, "not found in", source, ". Skipping...")  # skip missing diphones
             else:
-                print("Diphone", diphone, "not found in", args.diphones, ". Skipping...")  # skip missing diphones
-                continue
+                units.append(unit_id)
+        return np.array(units, dtype=np.int32)
 
+    def get_wavs(self, phone_sequence):
+        """
+        Convert a diphone sequence into a list of .wav filenames that can later be loaded as audio, keeping the
+        silence markers as they are. With a packed bank, the unit names are returned instead of filenames.
+        """
+        wavs_for_concatenation = []
+        for unit_id in self.get_units(phone_sequence):
+            name = self.unit_names[unit_id]
+            if self.bank is None and name not in self.silences:
+                name = self.wav_folder + "/" + name + ".wav"  # make diphone filenames
+            wavs_for_concatenation.append(name)
         return wavs_for_concatenation
 
-    def make_and_concatenate_chunks(self):
+    def version(self):
+        """Identify the diphone data in use, so cached audio from a different voice or bank build isn't reused."""
+        if self.bank is not None:
+            return self.bank.version
+        if self.unit_table is None:
+            self.load_units()
+        return self.wav_folder + ":" + self.folder_version
+
+    def iter_units(self, units):
+        """
+        Yield the audio data of each unit ID in turn, with the silence units replaced by the actual silences
+        (i.e zeroes). Units are only loaded when they are reached, so the first one is ready straight away.
+        """
+        silence_ids = len(self.unit_names) - 2  # the silences are always the last two units
+        unit_bytes = 0  # counted once at the end rather than per unit, to keep the loop cheap
+        try:
+            for unit_id in units:
+                if unit_id >= silence_ids:
+                    yield self.silences[self.unit_names[unit_id]]
+                    continue
+                if self.bank is not None:
+                    chunk = self.bank.unit(unit_id)  # zero-copy view into the memory-mapped bank
+                else:
+                    path = self.wav_folder + "/" + self.unit_names[unit_id] + ".wav"
+                    chunk = audio_interface.load_wav(path)[0]  # decoded once, then served from cache
+                unit_bytes += chunk.nbytes
+                yield chunk
+        finally:
+            self.metrics.count("unit_bytes", unit_bytes)
+
+    def iter_chunks(self, phone_sequence):
+        """Yield the audio data of each diphone in a diphone sequence in turn, see get_units and iter_units."""
+        return self.iter_units(self.get_units(phone_sequence))
+
+    def make_and_concatenate_chunks(self, phone_sequence, crossfade=False):
         """
         First insert the actual silences (i.e zeroes), and load the corresponding audio data for each diphone file.
         Includes the option to crossfade each file. Finally, return a fully-formed ndarray that can be fed into
         our audio interface.
         """
 
-        temp_audio = audio_interface.Audio(rate=SAMPLE_RATE)
+        units = self.get_units(phone_sequence)
 
-        # define silences as an ndarray of some length of zeroes
-        two_hundred_ms_silence = np.zeros(int(SAMPLE_RATE * 0.2), temp_audio.nptype)
-        four_hundred_ms_silence = np.zeros(int(SAMPLE_RATE * 0.4), temp_audio.nptype)
-
-        # get the list of files we need to concatenate
-        wav_filenames_and_silences = self.get_wavs()
-
-        # make a list of actual audio chunks, replacing the silence marker with the corresponding zeroes
-        chunks_out_list = []
-        for chunk in wav_filenames_and_silences:
-            if chunk == "200ms-silence":
-                chunks_out_list.append(two_hundred_ms_silence)
-            elif chunk == "400ms-silence":
-                chunks_out_list.append(four_hundred_ms_silence)
+        with self.metrics.stage("concatenate", crossfade=crossfade, units=len(units)):
+            # make a list of actual audio chunks, or whole phrases when they can come from the cache
+            if self.cache is not None:
+                chunks_out_list = list(self.iter_phrases(units, crossfade))
             else:
-                temp_audio.load(chunk)
-                chunks_out_list.append(temp_audio.data)
-
-        # TD-PSOLA: taper head and tail of chunks towards 0 over 10ms, overlap by 10ms
-        if args.crossfade:
-            print("Crossfading...")
-            millisec = int(SAMPLE_RATE/100)  # equivalent to 10ms worth of samples at the current rate
-            # build a list of factors, from 0 to 1, which we will use to taper the volume of each chunk
-            crossfade_factor = [(round(0 + (i * (1 / millisec)), 3)) for i in range(0, millisec)]
-
-            # first, taper the chunks
-            tapered_chunks_out_list = []
-            for chunk in chunks_out_list:
-                # make tapered first and last 10ms of the chunk
-                head_taper = np.multiply(crossfade_factor, chunk[:millisec])
-                tail_taper = np.multiply(crossfade_factor, chunk[-millisec:])
-                chunk[:millisec] = head_taper   # replace the first 10ms with our new tapered data
-                chunk[-millisec:] = tail_taper  # replace the last 10ms
-                tapered_chunks_out_list.append(chunk)
-
-            # next, overlap the tapered chunks
-            overlapped_chunks = []
-            deletion_index = [i for i in range(0, millisec)]  # define a list of indices to delete when overlapping
-            for i, chunk in enumerate(tapered_chunks_out_list):
-                next_chunk = tapered_chunks_out_list[(i + 1) % len(tapered_chunks_out_list)]
-                # overlap tail of current chunk with head of next chunk
-                overlapped_tail = np.add(chunk[-millisec:], next_chunk[:millisec])
-                chunk[-millisec:] = overlapped_tail
-                # 'move' the next chunk by deleting the first 10ms, which are now in the last 10ms of the current chunk.
-                shortened_next_chunk = np.delete(next_chunk, deletion_index)
-                tapered_chunks_out_list[(i + 1) % len(tapered_chunks_out_list)] = shortened_next_chunk
-                overlapped_chunks.append(chunk)
-
-            concatenated_chunks = np.concatenate(overlapped_chunks)
-
-        else:  # if crossfade option not used
-            concatenated_chunks = np.concatenate(chunks_out_list)
+                chunks_out_list = list(self.iter_units(units))
+
+            if not chunks_out_list:
+                return np.array([], dtype=np.int16)
+
+            # taper head and tail of chunks towards 0 and overlap them, see overlap_add.OverlapAdd
+            if crossfade:
+                print("Crossfading...")
+                concatenated_chunks = self.crossfader(chunks_out_list)
 
+            else:  # if crossfade option not used
+                concatenated_chunks = np.concatenate(chunks_out_list)
+
+        self.metrics.peak("buffer_bytes", concatenated_chunks.nbytes)
         return concatenated_chunks
 
+    def found(self, phone_sequence):
+        """Return a boolean array marking the diphones of a sequence that get_units will find, and not skip."""
+        if self.unit_table is None:
+            self.load_units()
+        if isinstance(phone_sequence, np.ndarray):
+            phone_sequence = phone_sequence.reshape(-1, 2)
+            return self.unit_table[phone_sequence[:, 0], phone_sequence[:, 1]] >= 0
+        return np.array([diphone.lower() in self.unit_ids for diphone in phone_sequence], dtype=bool)
+
+    def load_pitch_marks(self):
+        """Load the bank's pitch marks, which TD-PSOLA can't do without."""
+        if self.pitch_marks is None and self.bank is not None:
+            self.pitch_marks = pitch_marks.load_marks(self.bank)
+        if self.pitch_marks is None:
+            raise FileNotFoundError("Prosody control needs a packed bank with pitch marks. Build them with "
+                                    "python diphone_bank.py, or python pitch_marks.py for an existing bank.")
+        return self.pitch_marks
+
+    def unit_marks(self, units, chunks):
+        """The (marks, voiced) lists of each unit, from the pitch mark index. Silences get evenly spaced marks."""
+        silence_ids = len(self.unit_names) - 2
+        step = int(SAMPLE_RATE * pitch_marks.UNVOICED_MS / 1000)
+        marks = []
+        voiced = []
+        for unit_id, chunk in zip(units, chunks):
+            if unit_id >= silence_ids:
+                marks.append(np.arange(0, len(chunk), step))
+                voiced.append(np.zeros(len(marks[-1]), dtype=bool))
+            else:
+                unit_marks, unit_voiced = self.pitch_marks.unit(unit_id)
+                marks.append(unit_marks)
+                voiced.append(unit_voiced)
+        return marks, voiced
+
+    def make_prosody(self, phone_sequence, durations=None, f0=None, duration_scale=1.0):
+        """
+        TD-PSOLA version of make_and_concatenate_chunks, see psola.Psola: every diphone can be given its own duration
+        and pitch. durations (in seconds) and f0 (in Hz) hold one target per diphone of phone_sequence, or a single
+        value for all of them; nan or None keeps a diphone's recorded pitch, or its recorded duration times
+        duration_scale. The targets of missing diphones are skipped along with the diphones. The pitch marks were found
+        when the bank was built, so the only cost here is the overlap-add itself.
+        """
+        self.load_pitch_marks()
+        keep = self.found(phone_sequence)
+        units = self.get_units(phone_sequence)
+
+        with self.metrics.stage("psola", units=len(units)):
+            chunks = list(self.iter_units(units))
+            if not chunks:
+                return np.array([], dtype=np.int16)
+            marks, voiced = self.unit_marks(units, chunks)
+            lengths = np.array([len(chunk) for chunk in chunks], dtype=np.float64)
+            targets = self.unit_targets(durations, keep) * SAMPLE_RATE
+            targets = np.where(np.isnan(targets), lengths * duration_scale, targets)
+            concatenated_chunks = self.psola(chunks, marks, voiced, targets, self.unit_targets(f0, keep))
+            self.metrics.count("psola_marks", sum(len(unit_marks) for unit_marks in marks))
+
+        # the overlap-add works in two float32 buffers the length of the output
+        self.metrics.peak("buffer_bytes", len(concatenated_chunks) * 8)
+        return concatenated_chunks
+
+    @staticmethod
+    def unit_targets(targets, keep):
+        """Per-diphone targets (a sequence, a single value or None) as a float array for the diphones kept."""
+        if targets is None:
+            return np.full(int(keep.sum()), np.nan)
+        targets = np.asarray(targets, dtype=np.float64)
+        if targets.ndim == 0:
+            return np.full(int(keep.sum()), float(targets))
+        if len(targets) != len(keep):
+            raise ValueError("Expected one prosody target per diphone, got " + str(len(targets)) + " for " +
+                             str(len(keep)) + " diphones.")
+        return targets[keep]
+
+    def iter_phrases(self, units, crossfade=False):
+        """
+        Like iter_units, but yield each phrase (a run of diphones between silences) as one chunk, taken from
+        self.cache when the same phrase has been synthesised before with the same options.
+        """
+        silence_ids = len(self.unit_names) - 2
+        boundaries = np.flatnonzero(units >= silence_ids)
+        start = 0
+        for end in list(boundaries) + [len(units)]:  # the end of the sequence closes the last phrase
+            if end > start:
+                phrase = units[start:end]
+                key = (phrase.tobytes(), crossfade, self.crossfader.overlap, self.crossfader.window, self.version())
+                phrase_audio = self.cache.get_phrase(key)
+                self.metrics.count("phrase_cache_hits" if phrase_audio is not None else "phrase_cache_misses")
+                if phrase_audio is None:
+                    phrase_chunks = list(self.iter_units(phrase))
+                    phrase_audio = self.crossfader(phrase_chunks) if crossfade else np.concatenate(phrase_chunks)
+                    self.cache.put_phrase(key, phrase_audio)
+                yield phrase_audio
+            if end < len(units):
+                yield from self.iter_units(units[end:end + 1])  # the silence itself
+            start = end + 1
+
+    def stream_chunks(self, phone_sequence, crossfade=False):
+        """
+        Streaming version of make_and_concatenate_chunks: a generator of audio blocks, one per diphone, yielded as
+        soon as each unit is resolved. With crossfade, the overlap is carried across block boundaries, so the
+        joined blocks are the same as the output of make_and_concatenate_chunks.
+        """
+        if crossfade:
+            return self.crossfader.stream(self.iter_chunks(phone_sequence))
+        return self.iter_chunks(phone_sequence)
+
+
+def load_bank(bank_path):
+    """Memory-map the packed diphone bank at bank_path, or return None if it hasn't been compiled."""
+    if os.path.exists(bank_path + diphone_bank.INDEX_SUFFIX):
+        return diphone_bank.DiphoneBank(bank_path)
+    return None
+
+
+synths = {}  # warm Synth objects kept by synthesise between calls, keyed by the options that shape them
+# and their output stages, with buffers reused between calls. OutputStage isn't thread-safe, so each thread has its
+# own dict of them, keyed by (rate, normalise)
+output_stages = threading.local()
 
-if __name__ == "__main__":
 
-    utt = Utterance(args.phrase[0])  # instantiate utterance object with user's phrase
-    utt.tokenise()  # do the tokenisation
-    synth = Synth()  # instantiate synthesis object
-    final_output = audio_interface.Audio(rate=SAMPLE_RATE)  # instantiate output object to take our final synth data
-    final_output.data = synth.make_and_concatenate_chunks()  # give it the final audio data array
+def synthesise(text, crossfade=False, volume=100, overlap_ms=overlap_add.OVERLAP_MS, window="linear",
+               diphones="./diphones", bank="./diphones.bank", lexicon_path=lexicon.LEXICON_PATH, save=None,
+               play=False, rate=None, normalise="peak", psola=False, f0=None, durations=None, duration_scale=1.0):
+    """
+    Library entry point: turn text into an int16 ndarray of audio at rate (SAMPLE_RATE by default), with the same
+    options as the command line. With psola, or any of the prosody targets f0, durations and duration_scale, the
+    diphones are joined by TD-PSOLA instead, see Synth.make_prosody. The lexicon, diphone bank and Synth are loaded
+    on the first call and reused by later calls with the same options. save is an optional .wav path to write the
+    audio to. PortAudio is only initialised if play is True.
+    """
+    if not 0 <= volume <= 100:
+        raise ValueError("volume expected a value between 0 and 100.")
+    if rate is not None and rate <= 0:
+        raise ValueError("rate expected a positive sample rate in Hz.")
+
+    synth_key = (diphones, bank, overlap_ms, window)
+    synth = synths.get(synth_key)
+    if synth is None:
+        synth = synths[synth_key] = Synth(load_bank(bank), overlap_ms, window, diphones)
+
+    utt = Utterance(text, lexicon.load_lexicon(lexicon_path))
+    utt.tokenise()
+    if psola or f0 is not None or durations is not None or duration_scale != 1.0:
+        data = synth.make_prosody(utt.get_diphone_ids(), durations, f0, duration_scale)
+    else:
+        data = synth.make_and_concatenate_chunks(utt.get_diphone_ids(), crossfade)
+    rate = rate or SAMPLE_RATE
+    stages = getattr(output_stages, "stages", None)
+    if stages is None:
+        stages = output_stages.stages = {}
+    stage = stages.get((rate, normalise))
+    if stage is None:
+        stage = stages[(rate, normalise)] = output_dsp.OutputStage(SAMPLE_RATE, rate, normalise)
+    data = stage.process(data, volume).copy()  # the stage's buffer is reused by the next call
+
+    if save:
+        audio_interface.write_wav(save, data, rate)
+    if play:
+        output = audio_interface.Audio(rate=rate)
+        output.data = data
+        output.play()
+        output.terminate()
+    return data
+
+
+synthesize = synthesise  # the same function, under the American spelling
+
+
+if __name__ == "__main__":
 
-    # handle volume:
-    if args.volume:
-        if 100 >= args.volume >= 0:
-            final_output.rescale(args.volume / 100)     # convert user input to range 0,1
+    parser = argparse.ArgumentParser(
+        description='A basic object oriented text-to-speech program using diphone speech synthesis.')
+    parser.add_argument('--diphones', default="./diphones", help="Relative path to folder containing diphone .wavs")
+    parser.add_argument('--bank', default="./diphones.bank",
+                        help="Path to a packed diphone bank built by diphone_bank.py. Used instead of --diphones if "
+                             "it exists")
+    parser.add_argument('--lexicon', default=lexicon.LEXICON_PATH,
+                        help="Path to a compiled lexicon built by lexicon.py. NLTK's CMUdict is used if it doesn't "
+                             "exist")
+    parser.add_argument('--play', '-p', action="store_true", default=True, help="Play the processed audio data")
+    parser.add_argument('--no-play', action="store_false", dest="play",
+                        help="Don't play the audio, e.g when only saving it. The audio device is then never opened")
+    parser.add_argument('--stream', action="store_true", default=False,
+                        help="Start playing as soon as the first diphone is ready, instead of after the whole phrase")
+    parser.add_argument('--frames-per-buffer', default=audio_interface.CHUNK, type=int,
+                        help="Frames handed to the audio device per callback. Larger values are less prone to "
+                             "underruns")
+    parser.add_argument('--save', '-s', action="store", dest="outfile", type=str,
+                        help="Save the audio output to a file", default=None)
+    parser.add_argument('phrase', nargs=1, help="The phrase to be synthesised")
+    parser.add_argument('--crossfade', '-c', action="store_true", default=False,
+                        help="Enable smoother concatenation by cross-fading between diphone units")
+    parser.add_argument('--overlap-ms', default=overlap_add.OVERLAP_MS, type=float,
+                        help="Length in milliseconds of the crossfade between neighbouring diphones")
+    parser.add_argument('--window', default="linear", choices=overlap_add.WINDOWS,
+                        help="Shape of the crossfade taper")
+    parser.add_argument('--psola', action="store_true", default=False,
+                        help="Join diphones by pitch-synchronous overlap-add (TD-PSOLA), using the pitch marks built "
+                             "with the bank. Implied by --pitch and --duration-scale. Not streamed")
+    parser.add_argument('--pitch', default=None, type=float, help="Target pitch in Hz for the voiced speech")
+    parser.add_argument('--pitch-end', default=None, type=float,
+                        help="Target pitch in Hz at the end of the phrase, gliding from --pitch at the start")
+    parser.add_argument('--duration-scale', default=1.0, type=float,
+                        help="Multiply the duration of every diphone, e.g 1.5 for slower speech")
+    parser.add_argument('--volume', '-v', default=100, type=int,
+                        help="Integer between 0 and 100, representing final output volume")
+    parser.add_argument('--normalise', default="peak", choices=output_dsp.NORMALISATIONS,
+                        help="Scale the volume by the peak sample, or by the RMS level, for more even loudness "
+                             "between phrases")
+    parser.add_argument('--rate', default=SAMPLE_RATE, type=int,
+                        help="Sample rate in Hz to play and save at, e.g 8000, 22050 or 48000. The diphones are "
+                             "resampled from " + str(SAMPLE_RATE) + " Hz")
+    parser.add_argument('--metrics-log', default=None, help="Append a JSON line per pipeline stage to this file")
+    parser.add_argument('--metrics-prom', default=None,
+                        help="Write the pipeline metrics to this Prometheus text file at the end")
+    args = parser.parse_args()
+
+    if args.metrics_log:
+        instrumentation.metrics.add_hook(instrumentation.JsonLinesExporter(args.metrics_log))
+
+    if args.overlap_ms < 0:
+        print("--overlap-ms expected a length of 0 or more milliseconds.")
+        quit(0)
+
+    utt = Utterance(args.phrase[0], lexicon.load_lexicon(args.lexicon))  # instantiate utterance with user's phrase
+    try:
+        utt.tokenise()  # do the tokenisation
+    except Exception as e:
+        print(e)  # since most errors here will be caused by incorrect/missing args, just print any error.
+        print("Please make sure you are using arguments as specified in --help or the readme.")
+    phone_sequence = utt.get_diphone_ids()  # get the sequence of diphones in user's phrase, as phone ID pairs
+    bank = load_bank(args.bank)  # memory-map the packed bank once, if there is one
+    synth = Synth(bank, args.overlap_ms, args.window, args.diphones)  # instantiate synthesis object
+    final_output = audio_interface.Audio(rate=args.rate)  # instantiate output object to take our final synth data
+
+    if not 100 >= args.volume >= 0:
+        print("--volume/-v expected one argument between 0 and 100.")
+        quit(0)
+    if args.rate <= 0:
+        print("--rate expected a positive sample rate in Hz.")
+        quit(0)
+    output_stage = output_dsp.OutputStage(SAMPLE_RATE, args.rate, args.normalise)  # resampling and volume
+
+    use_psola = args.psola or args.pitch is not None or args.duration_scale != 1.0
+    if args.pitch_end is not None and args.pitch is None:
+        print("--pitch-end expected --pitch for the pitch at the start.")
+        quit(0)
+    if args.pitch is not None and args.pitch <= 0 or args.pitch_end is not None and args.pitch_end <= 0:
+        print("--pitch and --pitch-end expected a positive pitch in Hz.")
+        quit(0)
+    if args.duration_scale <= 0:
+        print("--duration-scale expected a positive number.")
+        quit(0)
+
+    if args.stream and args.play and not use_psola:
+        # the peak and RMS aren't known until the end, so streamed audio gets a plain gain instead of normalisation.
+        # play_stream keeps every block, so each is copied out of the output stage's reused buffer
+        blocks = (block.copy() for block in output_stage.stream(synth.stream_chunks(phone_sequence, args.crossfade),
+                                                                  args.volume))
+        # afterwards, final_output.data holds everything that was played
+        final_output.play_stream(blocks, args.frames_per_buffer)
+
+    else:
+        if use_psola:
+            pitch_targets = args.pitch
+            if args.pitch_end is not None:  # one target per diphone, for a straight glide from start to end
+                pitch_targets = np.linspace(args.pitch, args.pitch_end, len(phone_sequence))
+            try:
+                data = synth.make_prosody(phone_sequence, None, pitch_targets, args.duration_scale)
+            except FileNotFoundError as e:
+                print(e)
+                quit(0)
         else:
-            print("--volume/-v expected one argument between 0 and 100.")
-            quit(0)
+            data = synth.make_and_concatenate_chunks(phone_sequence, args.crossfade)
 
-    # play!
-    if args.play:
-        final_output.play()
+        # resample to --rate and handle volume:
+        final_output.data = output_stage.process(data, args.volume)  # give it the audio data
+
+        # play!
+        if args.play:
+            final_output.play(args.frames_per_buffer)
 
     # save the file:
     if args.outfile:
@@ -356,3 +597,6 @@ if __name__ == "__main__":
             print("Could not find the directory to save audio output to. Please check the filename string supplied to "
                   "--save/-s.")
             quit(0)
+
+    if args.metrics_prom:
+        instrumentation.write_prometheus(args.metrics_prom)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# DiphoneSynth
+# Document mode: synthesise a long text sentence by sentence straight into a .wav file, in flat memory.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import os
+import re
+import math
+import sys
+import time
+import argparse
+import contextlib
+import numpy as np
+import audio_interface
+import diphone_synth
+import lexicon
+import output_dsp
+import overlap_add
+
+
+MAX_SENTENCE_CHARS = 1000  # a "sentence" with no full stop in sight is broken at a space after this many characters
+BLOCK_SAMPLES = 2**20  # samples rescaled at a time in the volume pass
+
+# the end of a sentence: terminal punctuation, any closing quotes or brackets, then whitespace
+SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*\s+")
+
+
+def iter_sentences(lines, max_chars=MAX_SENTENCE_CHARS):
+    """
+    Split text, given as an iterable of lines (e.g an open file), into sentences, lazily, so only the sentence in
+    progress is ever held in memory. Sentences end at terminal punctuation followed by whitespace, and at blank lines.
+    """
+    pending = ""
+    for line in lines:
+        if not line.strip():  # a blank line ends the paragraph, and whatever sentence was in progress
+            if pending.strip():
+                yield pending.strip()
+            pending = ""
+            continue
+        pending += line if line.endswith("\n") else line + " "
+        start = 0
+        for match in SENTENCE_END.finditer(pending):
+            yield pending[start:match.end()].strip()
+            start = match.end()
+        pending = pending[start:]
+        while len(pending) > max_chars:
+            cut = pending.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            yield pending[:cut].strip()
+            pending = pending[cut:]
+    if pending.strip():
+        yield pending.strip()
+
+
+def gain_file(path, factor, block_samples=BLOCK_SAMPLES):
+    """
+    Second pass of the volume normalisation: multiply the samples of a 16-bit .wav written by WavWriter by factor in
+    place, a block at a time through a memory map, with the same fixed point gain as audio_interface.rescale and
+    output_dsp.OutputStage.
+    """
+    samples = np.memmap(path, dtype=np.int16, mode="r+", offset=audio_interface.WavWriter.HEADER_BYTES)
+    scratch = np.empty(min(block_samples, len(samples)), dtype=np.int32)  # reused for every block
+    for start in range(0, len(samples), block_samples):
+        block = samples[start:start + block_samples]
+        audio_interface.fixed_gain(block, factor, out=block, scratch=scratch)
+    samples.flush()
+    del samples
+
+
+def synthesise_document(sentences, out_path, synth, phone_lexicon=None, crossfade=False, volume=100, rate=None,
+                        normalise="peak"):
+    """
+    Synthesise every sentence independently, resample it to rate (SAMPLE_RATE by default) a block at a time, and
+    append its audio to a .wav file at out_path as it is produced, then normalise the volume by the document's peak or
+    RMS level in a second pass over the file. Memory use depends on the longest sentence, not on the length of the
+    document. Returns a dict with the number of sentences and frames written, the output rate, and the peak before
+    rescaling.
+    """
+    output_stage = output_dsp.OutputStage(diphone_synth.SAMPLE_RATE, rate, normalise)
+    peak = 0
+    energy = 0  # running sum of squares, for RMS normalisation
+    count = 0
+    with audio_interface.WavWriter(out_path, output_stage.out_rate) as writer:
+        for sentence in sentences:
+            utt = diphone_synth.Utterance(sentence, phone_lexicon)
+            utt.tokenise()
+            for block in output_stage.stream(synth.stream_chunks(utt.get_diphone_ids(), crossfade)):
+                writer.write(block)
+                peak = max(peak, audio_interface.peak(block))  # running level, for the volume pass
+                if normalise == "rms":
+                    energy += int(np.einsum("i,i->", block, block, dtype=np.int64))
+            count += 1
+    level = math.sqrt(energy / writer.frames) if normalise == "rms" and writer.frames else peak
+    factor = output_stage.factor_for_level(level, volume / 100)
+    if factor is not None:
+        gain_file(out_path, factor)
+    return {"sentences": count, "frames": writer.frames, "rate": output_stage.out_rate, "peak": peak}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Synthesise a long document sentence by sentence into a .wav file.")
+    parser.add_argument('document', help="Text file to read, or - for standard input")
+    parser.add_argument('--out', '-o', default="document.wav", help="The .wav file to write")
+    parser.add_argument('--diphones', default="./diphones", help="Relative path to folder containing diphone .wavs")
+    parser.add_argument('--bank', default="./diphones.bank",
+                        help="Path to a packed diphone bank built by diphone_bank.py. Used instead of --diphones if "
+                             "it exists")
+    parser.add_argument('--lexicon', default=lexicon.LEXICON_PATH,
+                        help="Path to a compiled lexicon built by lexicon.py. NLTK's CMUdict is used if it doesn't "
+                             "exist")
+    parser.add_argument('--crossfade', '-c', action="store_true", default=False,
+                        help="Enable smoother concatenation by cross-fading between diphone units")
+    parser.add_argument('--overlap-ms', default=overlap_add.OVERLAP_MS, type=float,
+                        help="Length in milliseconds of the crossfade between neighbouring diphones")
+    parser.add_argument('--window', default="linear", choices=overlap_add.WINDOWS, help="Shape of the crossfade taper")
+    parser.add_argument('--volume', '-v', default=100, type=int,
+                        help="Integer between 0 and 100, representing final output volume")
+    parser.add_argument('--normalise', default="peak", choices=output_dsp.NORMALISATIONS,
+                        help="Scale the volume by the peak sample, or by the RMS level of the whole document")
+    parser.add_argument('--rate', default=diphone_synth.SAMPLE_RATE, type=int,
+                        help="Sample rate in Hz to write the .wav file at, e.g 8000, 22050 or 48000")
+    parser.add_argument('--verbose', action="store_true", default=False, help="Show per-sentence progress output")
+    args = parser.parse_args()
+
+    if not 100 >= args.volume >= 0:
+        print("--volume/-v expected one argument between 0 and 100.")
+        quit(0)
+    if args.rate <= 0:
+        print("--rate expected a positive sample rate in Hz.")
+        quit(0)
+    if args.overlap_ms < 0:
+        print("--overlap-ms expected a length of 0 or more milliseconds.")
+        quit(0)
+
+    document_synth = diphone_synth.Synth(diphone_synth.load_bank(args.bank), args.overlap_ms, args.window,
+                                         args.diphones)
+    document_lexicon = lexicon.load_lexicon(args.lexicon)
+
+    start = time.perf_counter()
+    try:
+        with contextlib.ExitStack() as stack:
+            document = sys.stdin if args.document == "-" else stack.enter_context(open(args.document, encoding="utf-8"))
+            if not args.verbose:  # silence the per-sentence progress prints from Utterance and Synth
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+            result = synthesise_document(iter_sentences(document), args.out, document_synth, document_lexicon,
+                                         args.crossfade, args.volume, args.rate, args.normalise)
+    except audio_interface.WavTooLarge as e:  # the file holds the audio so far, before the volume pass
+        print(e)
+        print("Split the document into parts, or use a lower --rate, to synthesise the rest.")
+        quit(1)
+    elapsed = time.perf_counter() - start
+
+    print("Wrote", result["sentences"], "sentences,", round(result["frames"] / result["rate"], 1),
+          "s of audio, to", args.out, "in", round(elapsed, 2), "s")
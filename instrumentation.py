@@ -0,0 +1,183 @@
+# DiphoneSynth
+# Pipeline instrumentation: wall time per stage, counters (units resolved and missing, bytes loaded, cache hits) and
+# peak buffer sizes, with hooks for live events and exporters to JSON lines and the Prometheus text format.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import os
+import json
+import time
+import threading
+
+
+PROMETHEUS_PREFIX = "diphone_synth_"
+
+
+class Stage:
+    """Context manager that times one run of a stage and records it in its Metrics when the block ends."""
+
+    __slots__ = ("metrics", "name", "fields", "start")
+
+    def __init__(self, metrics, name, fields):
+        self.metrics = metrics
+        self.name = name
+        self.fields = fields  # extra details for hooks, e.g the number of diphones. can be added to inside the block
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.name, time.perf_counter() - self.start, **self.fields)
+        return False
+
+
+class NullStage:
+    """Stand-in for Stage while metrics are disabled, so instrumented code doesn't need to check."""
+
+    __slots__ = ("fields",)
+
+    def __init__(self):
+        self.fields = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Metrics:
+    """
+    Thread-safe collector of pipeline measurements. Only running totals are kept, so it stays small and cheap enough
+    to leave on: per stage, the number of runs and the total and longest wall time; named counters; and peaks.
+    One instance (metrics, below) is shared by every Utterance, Synth and Audio object in the process.
+    Primarily, use with metrics.stage(name, **fields): ..., to time a block,
+                   .count(name, n), to add to a counter, e.g "units_missing",
+                   .peak(name, value), to keep the largest value seen, e.g "buffer_bytes",
+                   .add_hook(function), to have function(event) called with a dict for every timed stage,
+                   .snapshot(), for everything recorded so far.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}  # stage name -> [runs, total seconds, longest seconds]
+        self.counters = {}
+        self.peaks = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def stage(self, name, **fields):
+        if not self.enabled:
+            return NullStage()
+        return Stage(self, name, fields)
+
+    def record(self, name, seconds, **fields):
+        """Record one run of a stage that took seconds, and pass it on to the hooks."""
+        if not self.enabled:
+            return
+        with self._lock:
+            totals = self.stages.get(name)
+            if totals is None:
+                totals = self.stages[name] = [0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += seconds
+            if seconds > totals[2]:
+                totals[2] = seconds
+        if self.hooks:
+            event = {"time": time.time(), "stage": name, "seconds": seconds}
+            event.update(fields)
+            for hook in list(self.hooks):
+                hook(event)
+
+    def count(self, name, n=1):
+        if not self.enabled or not n:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def peak(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            if value > self.peaks.get(name, 0):
+                self.peaks[name] = value
+
+    def add_hook(self, hook):
+        """Call hook(event) after every timed stage, where event is a dict of time, stage, seconds and the fields."""
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def snapshot(self):
+        """Return a dict of everything recorded so far."""
+        with self._lock:
+            stages = {name: {"runs": runs, "seconds": total, "max_seconds": longest, "mean_seconds": total / runs}
+                      for name, (runs, total, longest) in self.stages.items()}
+            return {"stages": stages, "counters": dict(self.counters), "peaks": dict(self.peaks)}
+
+    def reset(self):
+        """Forget everything recorded so far. Hooks are kept."""
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.peaks.clear()
+
+
+metrics = Metrics()  # process-wide metrics shared by every instrumented object
+
+
+class JsonLinesExporter:
+    """
+    Hook that appends every event to a JSON lines file, one object per line, e.g
+    {"time": 1700000000.0, "stage": "concatenate", "seconds": 0.012, "crossfade": true}.
+    Use metrics.add_hook(JsonLinesExporter(path)), and .close() at the end.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event) + "\n"
+        with self._lock:
+            self.file.write(line)
+            self.file.flush()  # one write per line, so a crash loses at most the current event
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+def prometheus_text(snapshot, prefix=PROMETHEUS_PREFIX):
+    """Format a Metrics.snapshot() in the Prometheus text exposition format."""
+    lines = ["# TYPE " + prefix + "stage_runs_total counter",
+             "# TYPE " + prefix + "stage_seconds_total counter",
+             "# TYPE " + prefix + "stage_seconds_max gauge"]
+    for name, stage in sorted(snapshot["stages"].items()):
+        label = '{stage="' + name + '"}'
+        lines.append(prefix + "stage_runs_total" + label + " " + str(stage["runs"]))
+        lines.append(prefix + "stage_seconds_total" + label + " " + repr(stage["seconds"]))
+        lines.append(prefix + "stage_seconds_max" + label + " " + repr(stage["max_seconds"]))
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append("# TYPE " + prefix + name + "_total counter")
+        lines.append(prefix + name + "_total " + str(value))
+    for name, value in sorted(snapshot["peaks"].items()):
+        lines.append("# TYPE " + prefix + name + "_peak gauge")
+        lines.append(prefix + name + "_peak " + str(value))
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, snapshot=None):
+    """
+    Write the current metrics (or a given snapshot) to a Prometheus text file, e.g for node_exporter's textfile
+    collector. The file is replaced atomically, so a scrape never sees half of it.
+    """
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as prometheus_file:
+        prometheus_file.write(prometheus_text(snapshot if snapshot is not None else metrics.snapshot()))
+    os.replace(temp_path, path)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+# DiphoneSynth
+# Compact pronunciation lexicon: CMUdict compiled to a sorted word array with packed phone IDs, plus a rule-based
+# letter-to-sound fallback for words the dictionary doesn't know.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import os
+import re
+import json
+import argparse
+import functools
+import numpy as np
+
+
+LEXICON_PATH = "./cmudict.lex"  # default location of the compiled lexicon folder
+
+# the ARPAbet phones used by CMUdict, without stress marks. stress is stripped when the lexicon is compiled, since
+# the diphone filenames don't carry it.
+PHONES = ("AA", "AE", "AH", "AO", "AW", "AY", "B", "CH", "D", "DH", "EH", "ER", "EY", "F", "G", "HH", "IH", "IY",
+          "JH", "K", "L", "M", "N", "NG", "OW", "OY", "P", "R", "S", "SH", "T", "TH", "UH", "UW", "V", "W", "Y", "Z",
+          "ZH")
+
+# the fixed inventory the whole front end works in: every phone is a small integer index into this tuple. after the
+# phones come the pause, and the two silences that punctuation is replaced with.
+INVENTORY = PHONES + ("PAU", "200ms-silence", "400ms-silence")
+PHONE_IDS = {phone: i for i, phone in enumerate(INVENTORY)}
+PAU = PHONE_IDS["PAU"]
+SILENCE_SHORT = PHONE_IDS["200ms-silence"]
+SILENCE_LONG = PHONE_IDS["400ms-silence"]
+
+# letter-to-sound rules, tried longest grapheme first at each position. each rule is
+# (grapheme, phones, letters allowed to follow it or None for any), and the first rule that fits wins.
+LTS_RULES = (
+    ("tion", ("SH", "AH", "N"), None), ("sion", ("ZH", "AH", "N"), None), ("ough", ("AO",), None),
+    ("igh", ("AY",), None), ("tch", ("CH",), None), ("dge", ("JH",), None),
+    ("ch", ("CH",), None), ("sh", ("SH",), None), ("th", ("TH",), None), ("ph", ("F",), None),
+    ("wh", ("W",), None), ("ng", ("NG",), None), ("ck", ("K",), None), ("qu", ("K", "W"), None),
+    ("kn", ("N",), None), ("wr", ("R",), None), ("gh", ("G",), None),
+    ("ee", ("IY",), None), ("ea", ("IY",), None), ("oo", ("UW",), None), ("ai", ("EY",), None),
+    ("ay", ("EY",), None), ("ey", ("IY",), None), ("oa", ("OW",), None), ("ou", ("AW",), None),
+    ("ow", ("OW",), None), ("oi", ("OY",), None), ("oy", ("OY",), None), ("au", ("AO",), None),
+    ("aw", ("AO",), None), ("ie", ("IY",), None), ("ew", ("UW",), None), ("er", ("ER",), None),
+    ("ir", ("ER",), None), ("ur", ("ER",), None), ("ar", ("AA", "R"), None), ("or", ("AO", "R"), None),
+    ("a", ("AE",), None), ("b", ("B",), None), ("c", ("S",), "eiy"), ("c", ("K",), None), ("d", ("D",), None),
+    ("e", ("EH",), None), ("f", ("F",), None), ("g", ("G",), None), ("h", ("HH",), None), ("i", ("IH",), None),
+    ("j", ("JH",), None), ("k", ("K",), None), ("l", ("L",), None), ("m", ("M",), None), ("n", ("N",), None),
+    ("o", ("AA",), None), ("p", ("P",), None), ("q", ("K",), None), ("r", ("R",), None), ("s", ("S",), None),
+    ("t", ("T",), None), ("u", ("AH",), None), ("v", ("V",), None), ("w", ("W",), None), ("x", ("K", "S"), None),
+    ("y", ("Y",), "aeiou"), ("y", ("IY",), None), ("z", ("Z",), None),
+)
+
+DIGIT_NAMES = ("zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine")
+
+
+def strip_stress(phone):
+    """Remove the stress digit from a CMUdict phone, e.g AH0 -> AH."""
+    return phone.rstrip("012")
+
+
+def letter_to_sound(word):
+    """
+    Guess a pronunciation for a word made of ascii letters with the LTS_RULES table. This is only a fallback for
+    words missing from the dictionary, so it aims to be understandable rather than correct.
+    """
+    word = word.lower()
+    if len(word) > 3 and word.endswith("e") and word[-2] not in "aeiouy":
+        word = word[:-1]  # final silent e
+
+    phones = []
+    i = 0
+    while i < len(word):
+        if i > 0 and word[i] == word[i - 1] and word[i] not in "aeiou":
+            i += 1  # doubled consonants are said once
+            continue
+        for grapheme, rule_phones, followed_by in LTS_RULES:
+            if word.startswith(grapheme, i):
+                following = word[i + len(grapheme):i + len(grapheme) + 1]
+                if followed_by is None or (following and following in followed_by):
+                    phones += rule_phones
+                    i += len(grapheme)
+                    break
+        else:
+            i += 1  # not a letter we have a rule for, so skip it
+    return tuple(phones)
+
+
+def compile_lexicon(lexicon_dir, phone_dict=None):
+    """
+    Build step: turn CMUdict (or any dict of word -> list of pronunciations) into a compact lexicon folder that
+    Lexicon.load can memory-map. Only the first pronunciation of each word is kept, with stress stripped.
+    """
+    if phone_dict is None:
+        from nltk.corpus import cmudict  # only the build step needs NLTK
+        phone_dict = cmudict.dict()
+
+    lexicon = Lexicon.from_phone_dict(phone_dict)
+    os.makedirs(lexicon_dir, exist_ok=True)
+    np.save(os.path.join(lexicon_dir, "words.npy"), lexicon.words)
+    np.save(os.path.join(lexicon_dir, "offsets.npy"), lexicon.offsets)
+    np.save(os.path.join(lexicon_dir, "phones.npy"), lexicon.phones)
+    with open(os.path.join(lexicon_dir, "inventory.json"), "w") as inventory_file:
+        json.dump(list(lexicon.inventory), inventory_file)
+    return lexicon
+
+
+class Lexicon:
+    """
+    Pronunciation lexicon stored as three arrays: a sorted array of words (as fixed-width utf-8 bytes), the offset
+    of each word's pronunciation, and all pronunciations packed end to end as phone IDs into inventory.
+    Lookups are a binary search, and pronunciations of out-of-vocabulary words come from letter_to_sound.
+    Primarily, use Lexicon.load(path), to memory-map a folder written by compile_lexicon,
+                   .pronounce_ids(word), which returns a tuple of IDs into INVENTORY (possibly empty), and is memoised,
+                   .pronounce(word), the same pronunciation as phone names.
+    """
+
+    def __init__(self, words, offsets, phones, inventory=PHONES):
+        self.words = words
+        self.offsets = offsets
+        self.phones = phones
+        self.inventory = tuple(inventory)
+        # stored IDs -> INVENTORY IDs, worked out once here so lookups never handle phone names
+        self.to_inventory = np.array([PHONE_IDS.get(phone, -1) for phone in self.inventory], dtype=np.int16)
+        self.oov_count = 0  # how many distinct words needed the letter-to-sound fallback
+        self.pronounce_ids = functools.lru_cache(maxsize=65536)(self._pronounce_ids)  # memoise per lexicon instance
+
+    @classmethod
+    def load(cls, lexicon_dir):
+        """Memory-map a compiled lexicon folder. Only the pages that lookups touch are ever read from disk."""
+        arrays = [np.load(os.path.join(lexicon_dir, name + ".npy"), mmap_mode="r")
+                  for name in ("words", "offsets", "phones")]
+        with open(os.path.join(lexicon_dir, "inventory.json")) as inventory_file:
+            inventory = json.load(inventory_file)
+        return cls(*arrays, inventory)
+
+    @classmethod
+    def from_phone_dict(cls, phone_dict):
+        """
+        Build a lexicon in memory from a dict of word -> list of pronunciations, like cmudict.dict(). Stress is
+        stripped here, once, and phones outside PHONES are dropped.
+        """
+        keys = sorted(word.encode("utf-8") for word, pronunciations in phone_dict.items() if pronunciations)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int32)
+        phones = []
+        for i, key in enumerate(keys):
+            for phone in phone_dict[key.decode("utf-8")][0]:
+                phone_id = PHONE_IDS.get(strip_stress(phone))
+                if phone_id is not None and phone_id < len(PHONES):
+                    phones.append(phone_id)
+            offsets[i + 1] = len(phones)
+        words = np.array(keys, dtype="S" + str(max((len(key) for key in keys), default=1)))
+        return cls(words, offsets, np.array(phones, dtype=np.uint8), PHONES)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return self.find(word) is not None
+
+    def find(self, word):
+        """Return the index of a word in the sorted word array, or None if it isn't in the lexicon."""
+        key = word.lower().encode("utf-8")
+        if len(key) > self.words.dtype.itemsize:
+            return None
+        i = int(np.searchsorted(self.words, key))
+        if i < len(self.words) and self.words[i] == key:
+            return i
+        return None
+
+    def lookup_ids(self, word):
+        """Return the dictionary pronunciation of a word as a tuple of INVENTORY IDs, or None if it isn't there."""
+        i = self.find(word)
+        if i is None:
+            return None
+        ids = self.to_inventory[self.phones[self.offsets[i]:self.offsets[i + 1]]]
+        return tuple(int(phone_id) for phone_id in ids if phone_id >= 0)
+
+    def lookup(self, word):
+        """Return the dictionary pronunciation of a word as a tuple of phones, or None if it isn't in the lexicon."""
+        ids = self.lookup_ids(word)
+        return None if ids is None else tuple(INVENTORY[phone_id] for phone_id in ids)
+
+    def pronounce(self, word):
+        """Return the pronunciation of any word as a tuple of phone names, using letter_to_sound if needed."""
+        return tuple(INVENTORY[phone_id] for phone_id in self.pronounce_ids(word))
+
+    def _pronounce_ids(self, word):
+        ids = self.lookup_ids(word)
+        if ids is not None:
+            return ids
+
+        self.oov_count += 1
+        result = []
+        for part in re.findall(r"[a-z]+|[0-9]", word.lower()):  # letter runs, and digits read out one by one
+            if part.isdigit():
+                part = DIGIT_NAMES[int(part)]
+            part_ids = self.lookup_ids(part)
+            if part_ids is None:
+                part_ids = tuple(PHONE_IDS[phone] for phone in letter_to_sound(part))
+            result += part_ids
+        return tuple(result)
+
+
+_loaded_lexicons = {}  # path -> Lexicon, so a process only loads each lexicon once
+
+
+def load_lexicon(lexicon_dir=LEXICON_PATH):
+    """
+    Return the lexicon compiled at lexicon_dir, or if it hasn't been compiled, one built in memory from NLTK's
+    CMUdict. Either way it is loaded once per process and shared.
+    """
+    lexicon = _loaded_lexicons.get(lexicon_dir)
+    if lexicon is None:
+        if os.path.exists(os.path.join(lexicon_dir, "inventory.json")):
+            lexicon = Lexicon.load(lexicon_dir)
+        else:
+            from nltk.corpus import cmudict
+            lexicon = Lexicon.from_phone_dict(cmudict.dict())
+        _loaded_lexicons[lexicon_dir] = lexicon
+    return lexicon
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Compile NLTK's CMU dictionary into a compact, memory-mappable lexicon.")
+    parser.add_argument('--lexicon', default=LEXICON_PATH, help="Folder to write the compiled lexicon to")
+    args = parser.parse_args()
+
+    compiled = compile_lexicon(args.lexicon)
+    print("Compiled", len(compiled), "words into", args.lexicon)
@@ -0,0 +1,189 @@
+# DiphoneSynth
+# Text normalisation: expand numbers, ordinals, money, times, percentages and dates into speakable words.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import re
+
+
+# set up tuples with names. naturally, integer input will be used as index to find the corresponding word.
+UNDER_TWENTY = ("zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "eleven",
+                "twelve", "thirteen", "fourteen", "fifteen", "sixteen", "seventeen", "eighteen", "nineteen")
+TENS = ("", "", "twenty", "thirty", "forty", "fifty", "sixty", "seventy", "eighty", "ninety")
+SCALES = ((10**12, "trillion"), (10**9, "billion"), (10**6, "million"), (1000, "thousand"))
+
+# the ordinal form of the last word of a number, for words that don't just take "th"
+ORDINAL_WORDS = {"one": "first", "two": "second", "three": "third", "five": "fifth", "eight": "eighth",
+                 "nine": "ninth", "twelve": "twelfth"}
+
+MONTH_NAMES = ("", "january", "february", "march", "april", "may", "june", "july", "august", "september", "october",
+               "november", "december")
+
+# currency symbol -> (unit singular, unit plural, subunit singular, subunit plural)
+CURRENCIES = {"$": ("dollar", "dollars", "cent", "cents"),
+              "£": ("pound", "pounds", "penny", "pence"),
+              "€": ("euro", "euros", "cent", "cents")}
+
+SYMBOLS = {"&": "and", "+": "plus", "@": "at", "=": "equals"}
+
+# one combined scanner for everything we expand. each alternative is a named group, and the name of the group that
+# matched (match.lastgroup) picks the handler from HANDLERS below, so the text is expanded in one linear re.sub pass.
+# alternatives are tried in order, so the more specific patterns come first. the leading lookahead lets the scanner
+# skip past ordinary letters without trying every alternative at each of them.
+SCANNER = re.compile(r"""
+    (?=[\d$£€&+@=-])
+    (?:(?P<date>\b(?P<date_day>0?[1-9]|[12][0-9]|3[01])       # DD/MM/YY or DD/MM/YYYY, with / . or - separators
+        (?P<date_sep>[/.-])(?P<date_month>0?[1-9]|1[012])
+        (?P=date_sep)(?P<date_year>\d{4}|\d{2})\b)
+    |(?P<day_month>\b(?P<dm_day>0?[1-9]|[12][0-9]|3[01])   # DD/MM. only / here, so decimals like 1.5 aren't dates
+        /(?P<dm_month>0?[1-9]|1[012])\b(?![/.-]\d))
+    |(?P<time>\b(?P<time_hour>[01]?[0-9]|2[0-3]):(?P<time_minute>[0-5][0-9])(?!\d)   # HH:MM, with optional am/pm
+        (?:\s?(?P<time_period>[ap])\.?m\b(?:\.(?=\s+(?-i:[a-z])))?)?)   # a.m. mid-sentence keeps no full stop
+    |(?P<money>(?P<money_symbol>[$£€])\s?(?P<money_units>\d{1,3}(?:,\d{3})+|\d+)(?:\.(?P<money_subunits>\d{1,2}))?\b)
+    |(?P<percent>(?P<percent_number>\d+(?:\.\d+)?)\s?%)
+    |(?P<ordinal>\b(?P<ordinal_number>\d+)(?:st|nd|rd|th)\b)
+    |(?P<decimal>(?P<decimal_sign>(?<![\w.])-)?\b(?P<decimal_units>\d+)\.(?P<decimal_fraction>\d+)\b)
+    |(?P<integer>(?P<integer_sign>(?<![\w.])-)?\b(?P<integer_digits>\d{1,3}(?:,\d{3})+|\d+)\b)
+    |(?P<symbol>[&+@=]))
+    """, re.VERBOSE | re.IGNORECASE)
+
+
+def number_to_words(number):
+    """Spell out a non-negative integer, e.g 1234 -> "one thousand two hundred thirty four"."""
+    if number < 20:
+        return UNDER_TWENTY[number]
+    if number < 100:
+        ten, unit = divmod(number, 10)
+        return TENS[ten] + (" " + UNDER_TWENTY[unit] if unit else "")
+    if number < 1000:
+        hundred, rest = divmod(number, 100)
+        return UNDER_TWENTY[hundred] + " hundred" + (" " + number_to_words(rest) if rest else "")
+    for scale, name in SCALES:
+        if number >= scale:
+            high, rest = divmod(number, scale)
+            return number_to_words(high) + " " + name + (" " + number_to_words(rest) if rest else "")
+    return " ".join(UNDER_TWENTY[int(digit)] for digit in str(number))  # beyond trillions, read the digits
+
+
+def ordinal_to_words(number):
+    """Spell out an ordinal, e.g 21 -> "twenty first"."""
+    words = number_to_words(number).split(" ")
+    last = words[-1]
+    if last in ORDINAL_WORDS:
+        words[-1] = ORDINAL_WORDS[last]
+    elif last.endswith("y"):
+        words[-1] = last[:-1] + "ieth"
+    else:
+        words[-1] = last + "th"
+    return " ".join(words)
+
+
+def digits_to_words(digits):
+    """Read a string of digits one at a time, e.g "05" -> "zero five"."""
+    return " ".join(UNDER_TWENTY[int(digit)] for digit in digits)
+
+
+def year_to_words(year):
+    """Read a year the way it's spoken, e.g 1914 -> "nineteen fourteen", 2005 -> "two thousand five"."""
+    if 2000 <= year < 2010 or year < 1000 or year >= 10000:
+        return number_to_words(year)
+    century, rest = divmod(year, 100)
+    if rest == 0:
+        return number_to_words(century) + " hundred"
+    if rest < 10:
+        return number_to_words(century) + " oh " + UNDER_TWENTY[rest]
+    return number_to_words(century) + " " + number_to_words(rest)
+
+
+def expand_date(match):
+    words = [ordinal_to_words(int(match.group("date_day"))), MONTH_NAMES[int(match.group("date_month"))], ","]
+    year = match.group("date_year")
+    if len(year) == 2:
+        words.append(("oh " + UNDER_TWENTY[int(year)]) if year[0] == "0" else number_to_words(int(year)))
+    else:
+        words.append(year_to_words(int(year)))
+    return " ".join(words)
+
+
+def expand_day_month(match):
+    return ordinal_to_words(int(match.group("dm_day"))) + " " + MONTH_NAMES[int(match.group("dm_month"))]
+
+
+def expand_time(match):
+    hour, minute = int(match.group("time_hour")), int(match.group("time_minute"))
+    if minute == 0:
+        words = number_to_words(hour) + (" o'clock" if not match.group("time_period") else "")
+    elif minute < 10:
+        words = number_to_words(hour) + " oh " + UNDER_TWENTY[minute]
+    else:
+        words = number_to_words(hour) + " " + number_to_words(minute)
+    if match.group("time_period"):
+        words += " " + match.group("time_period").lower() + " m"
+    return words
+
+
+def expand_money(match):
+    unit, units, subunit, subunits = CURRENCIES[match.group("money_symbol")]
+    amount = int(match.group("money_units").replace(",", ""))
+    words = number_to_words(amount) + " " + (unit if amount == 1 else units)
+    cents = match.group("money_subunits")
+    if cents:
+        cents = int(cents.ljust(2, "0"))  # $1.5 is one dollar fifty
+        if cents:
+            words += " and " + number_to_words(cents) + " " + (subunit if cents == 1 else subunits)
+    return words
+
+
+def expand_decimal_number(text):
+    units, _, fraction = text.partition(".")
+    words = number_to_words(int(units))
+    if fraction:
+        words += " point " + digits_to_words(fraction)
+    return words
+
+
+def expand_percent(match):
+    return expand_decimal_number(match.group("percent_number")) + " percent"
+
+
+def expand_ordinal(match):
+    return ordinal_to_words(int(match.group("ordinal_number")))
+
+
+def expand_decimal(match):
+    words = expand_decimal_number(match.group("decimal_units") + "." + match.group("decimal_fraction"))
+    return ("minus " if match.group("decimal_sign") else "") + words
+
+
+def expand_integer(match):
+    digits = match.group("integer_digits")
+    number = int(digits.replace(",", ""))
+    if len(digits) == 4 and 1100 <= number <= 2099:
+        words = year_to_words(number)  # a bare four digit number in this range is most likely a year
+    elif len(digits) > 1 and digits[0] == "0":
+        words = digits_to_words(digits)  # leading zeroes, e.g codes and phone numbers, read digit by digit
+    else:
+        words = number_to_words(number)
+    return ("minus " if match.group("integer_sign") else "") + words
+
+
+def expand_symbol(match):
+    return SYMBOLS[match.group("symbol")]
+
+
+HANDLERS = {"date": expand_date, "day_month": expand_day_month, "time": expand_time, "money": expand_money,
+            "percent": expand_percent, "ordinal": expand_ordinal, "decimal": expand_decimal,
+            "integer": expand_integer, "symbol": expand_symbol}
+
+
+def expand(match):
+    # pad with spaces so expansions never run into neighbouring words
+    return " " + HANDLERS[match.lastgroup](match) + " "
+
+
+def normalise(text):
+    """
+    Expand every number, ordinal, amount of money, time, percentage, date and symbol in text into words, in a
+    single pass over the text. Everything else is left as it is.
+    """
+    return SCANNER.sub(expand, text)
@@ -0,0 +1,221 @@
+# DiphoneSynth
+# Output post-processing: resampling to the output device's rate, peak or RMS normalisation and fixed point gain, in
+# buffers kept and reused from one utterance to the next.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import audio_interface
+import instrumentation
+
+
+NORMALISATIONS = ("peak", "rms")  # supported volume normalisations
+RMS_LEVEL = 0.1  # RMS of full volume under RMS normalisation, as a fraction of full scale (-20 dBFS)
+TAPS_PER_PHASE = 24  # length of each polyphase branch of the resampling filter, in input samples, when upsampling.
+                     # downsampling by a factor of r needs r times as many for the same transition band
+ROLLOFF = 0.9  # resampling filter cutoff, as a fraction of the lower Nyquist frequency
+KAISER_BETA = 8.0  # resampling filter window shape. higher is more stopband attenuation, for a wider transition
+BLOCK_OUTPUTS = 2**16  # output samples computed at a time, which bounds the resampler's working buffer
+
+
+def grow(buffer, length):
+    """Return buffer if it holds at least length items, otherwise a new one of the same dtype with room for them."""
+    if len(buffer) >= length:
+        return buffer
+    return np.empty(max(length, 2 * len(buffer)), dtype=buffer.dtype)
+
+
+class Resampler:
+    """
+    Polyphase FIR resampler between any two integer sample rates, e.g 16000 to 8000, 22050 or 48000 Hz. The rate
+    ratio is reduced to up / down, and output sample n is the dot product of TAPS_PER_PHASE input samples with one
+    phase of a Kaiser windowed sinc lowpass, so the upsampled signal is never built. Every up-th output uses the same
+    phase and starts down input samples further on, so each phase is one matrix-vector product over a strided view of
+    the input, with no copies. Output is computed BLOCK_OUTPUTS samples at a time into a buffer allocated once.
+    Primarily, use Resampler(in_rate, out_rate)(data), for a whole utterance,
+                   .feed(block), then .feed(last_block, final=True), for a stream of blocks.
+    Both return an int16 view into a buffer that the next call reuses, so copy it to keep it.
+    """
+
+    def __init__(self, in_rate, out_rate, taps_per_phase=TAPS_PER_PHASE, block_outputs=BLOCK_OUTPUTS):
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        divisor = math.gcd(in_rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+        self.taps = taps_per_phase * -(-self.down // self.up)
+        self.block_outputs = block_outputs
+
+        length = self.taps * self.up  # the prototype filter, at the upsampled rate
+        self.delay = (length - 1) // 2  # centre tap, so the output lines up with the input
+        cutoff = ROLLOFF * 0.5 / max(self.up, self.down)  # in cycles per upsampled sample
+        t = np.arange(length) - self.delay
+        prototype = np.sinc(2 * cutoff * t) * np.kaiser(length, KAISER_BETA)
+        prototype *= self.up / prototype.sum()  # unity gain at DC
+        # phases[p, k] is the tap applied by outputs of phase p to the k-th of the taps input samples ending at the
+        # most recent one, oldest first
+        self.phases = prototype.reshape(self.taps, self.up).T[:, ::-1].copy()
+
+        self.sums = np.empty(block_outputs)
+        self.history = np.zeros(self.taps + 1024)  # input samples still needed, grown as needed
+        self.windows = sliding_window_view(self.history, self.taps)  # windows[i] is history[i:i + taps], as a view
+        self.out = np.empty(0, dtype=np.int16)
+        self.reset()
+
+    def reset(self):
+        """Forget any stream in progress."""
+        self.start = -self.taps  # input index of history[0]. the zeros before the first sample pad the first outputs
+        self.held = self.taps
+        self.history[:self.held] = 0
+        self.received = 0  # input samples fed so far
+        self.produced = 0  # output samples returned so far
+
+    def output_length(self, samples):
+        """Number of output samples for samples of input."""
+        return -(-samples * self.up // self.down)
+
+    def __call__(self, data):
+        """Resample a whole utterance of int16 data."""
+        self.reset()
+        return self.feed(data, final=True)
+
+    def feed(self, data, final=False):
+        """
+        Add the next block of a stream of int16 data and return all the output it completes. An output sample needs a
+        few input samples past it, so those are held back until the next block, or until final=True.
+        """
+        padding = self.taps + self.delay // self.up + 1 if final else 0  # zeros after the end, to finish the stream
+        if len(self.history) < self.held + len(data) + padding:
+            history = np.empty(2 * (self.held + len(data) + padding))
+            history[:self.held] = self.history[:self.held]
+            self.history = history
+            self.windows = sliding_window_view(self.history, self.taps)
+        self.history[self.held:self.held + len(data)] = data
+        self.held += len(data)
+        self.received += len(data)
+        if final:
+            self.history[self.held:self.held + padding] = 0
+            self.held += padding
+            end = self.output_length(self.received)
+        else:  # outputs whose newest tap is an input sample that has arrived
+            end = max(self.produced, -(-(self.received * self.up - self.delay) // self.down))
+
+        count = end - self.produced
+        self.out = grow(self.out, count)
+        for first in range(0, count, self.block_outputs):
+            n = min(self.block_outputs, count - first)
+            self.compute(self.produced + first, self.out[first:first + n])
+        self.produced = end
+
+        if final:
+            self.reset()
+        else:  # drop the input samples no later output will need
+            keep_from = (end * self.down + self.delay) // self.up - self.taps + 1 - self.start
+            if keep_from > 0:
+                self.history[:self.held - keep_from] = self.history[keep_from:self.held]
+                self.held -= keep_from
+                self.start += keep_from
+        return self.out[:count]
+
+    def compute(self, first, out):
+        """Compute output samples first to first + len(out) into out, from the input samples in history."""
+        n = len(out)
+        sums = self.sums[:n]
+        for offset in range(min(self.up, n)):
+            newest, phase = divmod((first + offset) * self.down + self.delay, self.up)  # in upsampled samples
+            row = newest - self.taps + 1 - self.start  # the window of input samples for output first + offset
+            outputs = sums[offset::self.up]
+            rows = self.windows[row:row + (len(outputs) - 1) * self.down + 1:self.down]
+            np.matmul(rows, self.phases[phase], out=outputs)
+        np.rint(sums, out=sums)
+        np.clip(sums, -audio_interface.MAX_AMP, audio_interface.MAX_AMP - 1, out=sums)
+        np.copyto(out, sums, casting="unsafe")
+
+
+class OutputStage:
+    """
+    The last stage of the pipeline, between concatenation and the speaker or file: resample to the output rate, then
+    scale to the volume by peak or RMS normalisation with audio_interface.fixed_gain, in place. The output and scratch
+    buffers are kept and grown as needed, so a long-running synth stops allocating once it has seen its longest
+    utterance. An OutputStage isn't thread-safe; give each thread its own.
+    Primarily, use OutputStage(in_rate, out_rate, normalise).process(data, volume), for a whole utterance,
+                   .stream(blocks, volume), or .feed(block, volume) for each block then .feed(empty, volume,
+                   final=True), for a stream of blocks, where the volume is a plain gain.
+    Both return int16 views into reused buffers, so copy them to keep them.
+    """
+
+    def __init__(self, in_rate, out_rate=None, normalise="peak"):
+        if normalise not in NORMALISATIONS:
+            raise ValueError("Unknown normalisation " + repr(normalise) + ", expected one of " +
+                             ", ".join(NORMALISATIONS))
+        self.in_rate = in_rate
+        self.out_rate = out_rate or in_rate
+        self.normalise = normalise
+        self.resampler = Resampler(in_rate, self.out_rate) if self.out_rate != in_rate else None
+        self.out = np.empty(0, dtype=np.int16)
+        self.scratch = np.empty(0, dtype=np.int32)
+        self.metrics = instrumentation.metrics
+
+    def reset(self):
+        """Forget any stream in progress."""
+        if self.resampler is not None:
+            self.resampler.reset()
+
+    def level_factor(self, data, volume):
+        """Gain that brings data to volume (between 0 and 1) by this stage's normalisation, or None for silence."""
+        if self.normalise == "rms":
+            level = math.sqrt(np.einsum("i,i->", data, data, dtype=np.float64) / len(data)) if len(data) else 0
+        else:
+            level = audio_interface.peak(data)
+        return self.factor_for_level(level, volume)
+
+    def factor_for_level(self, level, volume):
+        """
+        Gain that brings audio whose peak, or RMS under RMS normalisation, is level to volume (between 0 and 1), or
+        None for silence. For audio too long to measure in one go, e.g document mode's running peak.
+        """
+        if not level:
+            return None
+        if self.normalise == "rms":
+            return volume * RMS_LEVEL * audio_interface.MAX_AMP / level
+        return volume * audio_interface.MAX_AMP / level
+
+    def apply_gain(self, data, factor):
+        self.scratch = grow(self.scratch, len(data))
+        return audio_interface.fixed_gain(data, factor, out=data, scratch=self.scratch)
+
+    def process(self, data, volume=100):
+        """Resample and normalise an utterance of int16 data to volume, an integer from 0 to 100 (0 is silence)."""
+        with self.metrics.stage("output", samples=len(data), rate=self.out_rate, normalise=self.normalise):
+            if self.resampler is not None:
+                out = self.resampler(data)
+            else:
+                self.out = grow(self.out, len(data))
+                out = self.out[:len(data)]
+                np.copyto(out, data)
+            factor = self.level_factor(out, volume / 100)
+            if factor is not None:
+                self.apply_gain(out, factor)
+            return out
+
+    def stream(self, blocks, volume=100):
+        """Generator version of process, resampling each block as it comes. The volume is a plain gain."""
+        self.reset()
+        for block in blocks:
+            yield self.feed(block, volume)
+        if self.resampler is not None:
+            yield self.feed(np.array([], dtype=np.int16), volume, final=True)  # the output held back for lookahead
+
+    def feed(self, block, volume=100, final=False):
+        """Resample the next block of a stream and apply volume as a plain gain. Set final on (or after) the last."""
+        if self.resampler is not None:
+            out = self.resampler.feed(block, final)
+        else:
+            self.out = grow(self.out, len(block))
+            out = self.out[:len(block)]
+            np.copyto(out, block)
+        if volume != 100:  # full volume is a gain of 1
+            self.apply_gain(out, volume / 100)
+        return out
@@ -0,0 +1,132 @@
+# DiphoneSynth
+# Overlap-add crossfade engine for concatenating diphone units.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import numpy as np
+
+
+WINDOWS = ("linear", "hann")  # supported crossfade window shapes
+OVERLAP_MS = 10  # default overlap between neighbouring units
+
+
+def make_window(length, shape="linear"):
+    """
+    Return a fade-in ramp of the given length and shape, rising from 0 towards 1. Reverse it to fade out.
+    Samples sit at half-sample offsets so that a fade-in plus its reversed fade-out always sums to exactly 1.
+    """
+    steps = (np.arange(length, dtype=np.float32) + 0.5) / length
+    if shape == "linear":
+        return steps
+    elif shape == "hann":
+        return (0.5 - 0.5 * np.cos(np.pi * steps)).astype(np.float32)
+    else:
+        raise ValueError("Unknown crossfade window " + repr(shape) + ", expected one of " + ", ".join(WINDOWS))
+
+
+class OverlapAdd:
+    """
+    Taper the head and tail of each unit with a window and overlap neighbouring units, summing the overlapped region.
+    The units are concatenated once with their overlapped heads cut off, at about the cost of plain concatenation, and
+    only the junctions are crossfaded: the tail of every junction is gathered in one indexing operation per overlap
+    length, mixed with the head it overlaps using the precomputed fades, and scattered back. The input chunks are never
+    modified.
+    Primarily, use OverlapAdd(sample_rate, overlap_ms, window)(chunks), where chunks is a list of int16 ndarrays.
+    """
+
+    def __init__(self, sample_rate, overlap_ms=OVERLAP_MS, window="linear"):
+        if overlap_ms < 0:
+            raise ValueError("overlap_ms expected a length of 0 or more milliseconds.")
+        self.sample_rate = sample_rate
+        self.overlap = int(sample_rate * overlap_ms / 1000)  # overlap length in samples
+        self.window = window
+        self._fades = {}  # overlap length -> (fade_in, fade_out), precomputed once per length
+        if self.overlap > 0:
+            self.fades(self.overlap)
+
+    def fades(self, length):
+        """Return the (fade_in, fade_out) window pair for an overlap of the given length."""
+        pair = self._fades.get(length)
+        if pair is None:
+            fade_in = make_window(length, self.window)
+            pair = (fade_in, fade_in[::-1].copy())
+            self._fades[length] = pair
+        return pair
+
+    def junctions(self, lengths):
+        """
+        Overlap length at each junction between neighbouring units. Units too short to give up a full overlap at
+        both ends overlap by at most half their length instead.
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if len(lengths) < 2:
+            return np.zeros(0, dtype=np.int64)
+        halves = lengths // 2
+        return np.minimum(self.overlap, np.minimum(halves[:-1], halves[1:]))
+
+    def stream(self, chunks, dtype=np.int16):
+        """
+        Generator version of __call__: crossfade an iterable of chunks, yielding each unit's finished samples as soon
+        as the next unit is known. The faded tail of each unit is carried over and added to the head of the next,
+        so joining the yielded blocks gives exactly the same samples as __call__.
+        """
+        info = np.iinfo(dtype)
+        chunks = iter(chunks)
+        chunk = next(chunks, None)
+        head = 0
+        pending = None  # faded tail of the previous unit, waiting for the head of this one
+        while chunk is not None:
+            next_chunk = next(chunks, None)  # one unit of lookahead decides the overlap at this junction
+            n = len(chunk)
+            if next_chunk is None:
+                tail = 0
+            else:
+                tail = int(self.junctions([n, len(next_chunk)])[0])
+
+            block = np.empty(n - tail, dtype=dtype)
+            block[head:] = chunk[head:n - tail]
+            if head:  # only the overlap goes through floating point
+                mixed = chunk[:head] * self.fades(head)[0]
+                mixed += pending
+                np.clip(mixed, info.min, info.max, out=mixed)
+                np.rint(mixed, out=mixed)
+                block[:head] = mixed
+            if tail:
+                pending = chunk[n - tail:] * self.fades(tail)[1]
+            yield block
+            chunk, head = next_chunk, tail
+
+    def __call__(self, chunks, dtype=np.int16):
+        """Crossfade and concatenate a list of chunks, returning a single array of the given dtype."""
+        if not chunks:
+            return np.array([], dtype=dtype)
+        lengths = np.array([len(chunk) for chunk in chunks], dtype=np.int64)
+        overlaps = self.junctions(lengths)
+        if not overlaps.any():
+            return np.concatenate(chunks).astype(dtype, copy=False)
+        cuts = overlaps.tolist()
+        chunks = [np.asarray(chunk) for chunk in chunks]  # slices of plain arrays are much cheaper than of np.memmaps
+        out = np.concatenate([chunks[0]] + [chunk[cut:] for chunk, cut in zip(chunks[1:], cuts)])
+        out = out.astype(dtype, copy=False)
+        heads = np.concatenate([chunk[:cut] for chunk, cut in zip(chunks[1:], cuts)])  # the samples cut off
+        # junction j mixes the last overlaps[j] samples of unit j, which ends at ends[j] in out, with
+        # heads[head_starts[j]:head_starts[j] + overlaps[j]]
+        ends = np.cumsum(lengths[:-1] - np.concatenate(([0], overlaps[:-1])))
+        head_starts = np.concatenate(([0], np.cumsum(overlaps[:-1])))
+
+        info = np.iinfo(dtype)
+        for length in np.unique(overlaps[overlaps > 0]).tolist():  # usually just the one overlap
+            fade_in, fade_out = self.fades(length)
+            junctions = overlaps == length
+            offsets = np.arange(length)
+            tail_index = (ends[junctions] - length)[:, np.newaxis] + offsets  # one row per junction
+            if junctions.all():  # every junction overlaps by the same length, so the heads are already in rows
+                junction_heads = heads.reshape(-1, length)
+            else:
+                junction_heads = heads[head_starts[junctions][:, np.newaxis] + offsets]
+            mixed = out[tail_index] * fade_out
+            mixed += junction_heads * fade_in
+            np.clip(mixed, info.min, info.max, out=mixed)  # overlapped peaks can exceed the sample range
+            np.rint(mixed, out=mixed)
+            out[tail_index] = mixed
+        return out
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# DiphoneSynth
+# Pitch mark index: the pitch epochs of every diphone in a packed bank, detected once at build time and stored next to
+# the bank, for pitch-synchronous synthesis (see psola.py).
+# hypnaceae on github
+# License: GNU GPL v3
+
+import os
+import warnings
+import argparse
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+MARKS_SUFFIX = ".marks.npz"  # the index lives next to the bank, e.g diphones.bank + diphones.bank.marks.npz
+F0_MIN = 60  # lowest and highest pitch searched for, in Hz
+F0_MAX = 400
+FRAME_MS = 40  # pitch analysis frame, long enough for two periods at F0_MIN
+HOP_MS = 5
+VOICING_THRESHOLD = 0.45  # normalised autocorrelation peak above which a frame counts as voiced
+OCTAVE_TOLERANCE = 0.9  # the shortest lag scoring this fraction of the best one wins, to avoid halving the pitch
+SILENCE_RMS = 100  # frames quieter than this (in 16-bit sample units) are never voiced
+UNVOICED_MS = 10  # spacing of the marks placed through unvoiced stretches and silence
+SMOOTHING_FRAMES = 5  # length of the median filter over the period track, which removes isolated octave errors
+
+
+def track_periods(samples, sample_rate):
+    """
+    Estimate the pitch period of every analysis frame by autocorrelation, all frames at once with one FFT. Returns
+    (periods, hop), where periods holds each frame's period in samples, 0 for unvoiced frames, and frame i is centred
+    on sample i * hop. The autocorrelation is divided by that of the analysis window, so the taper doesn't bias the
+    peak towards short lags, and of the peaks close to the highest the shortest lag is taken, since a multiple of the
+    period scores almost as well as the period itself.
+    """
+    frame = int(sample_rate * FRAME_MS / 1000)
+    hop = int(sample_rate * HOP_MS / 1000)
+    lag_min = int(sample_rate / F0_MAX)
+    lag_max = min(int(sample_rate / F0_MIN), frame - 1)
+    padded = np.pad(np.asarray(samples, dtype=np.float64), frame // 2)  # so frames are centred on multiples of hop
+    if len(padded) < frame:
+        return np.zeros(0, dtype=np.int64), hop
+
+    frames = sliding_window_view(padded, frame)[::hop]
+    frames = frames - frames.mean(axis=1, keepdims=True)
+    window = np.hanning(frame)
+    spectra = np.fft.rfft(frames * window, 2 * frame)
+    autocorrelation = np.fft.irfft(spectra.real ** 2 + spectra.imag ** 2)[:, :lag_max + 1]
+    window_spectrum = np.fft.rfft(window, 2 * frame)
+    window_autocorrelation = np.fft.irfft(np.abs(window_spectrum) ** 2)[:lag_max + 1]
+
+    energy = autocorrelation[:, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normalised = (autocorrelation[:, lag_min:] / energy[:, np.newaxis]) / \
+                     (window_autocorrelation[lag_min:] / window_autocorrelation[0])
+    normalised[~np.isfinite(normalised)] = 0
+    strength = normalised.max(axis=1)
+    peaks = np.zeros(normalised.shape, dtype=bool)  # local maxima of each frame's autocorrelation
+    peaks[:, 1:-1] = (normalised[:, 1:-1] >= normalised[:, :-2]) & (normalised[:, 1:-1] >= normalised[:, 2:])
+    candidates = peaks & (normalised >= OCTAVE_TOLERANCE * strength[:, np.newaxis])
+    candidates[np.arange(len(normalised)), np.argmax(normalised, axis=1)] = True  # the best lag, even at an edge
+    best = np.argmax(candidates, axis=1)
+    rms = np.sqrt(energy / np.sum(window ** 2))
+
+    periods = (best + lag_min).astype(np.float64)
+    unvoiced = (strength < VOICING_THRESHOLD) | (rms < SILENCE_RMS)
+    periods[unvoiced] = np.nan
+    edge = SMOOTHING_FRAMES // 2
+    with warnings.catch_warnings():  # frames next to unvoiced ones take the median of their voiced neighbours
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-unvoiced windows give nan, and are unvoiced anyway
+        smoothed = np.nanmedian(sliding_window_view(np.pad(periods, edge, constant_values=np.nan), SMOOTHING_FRAMES),
+                                axis=1)
+    smoothed[unvoiced] = 0
+    return smoothed.astype(np.int64), hop
+
+
+def detect_marks(samples, sample_rate):
+    """
+    Find the pitch epochs of one unit. In voiced stretches, each mark is the largest sample (of the unit's dominant
+    polarity) between 0.8 and 1.2 periods after the last one, so the marks follow the glottal pulses. Unvoiced
+    stretches get evenly spaced marks every UNVOICED_MS. Returns (marks, voiced): the sample position of every mark,
+    in order, and whether each one is voiced.
+    """
+    signal = np.asarray(samples, dtype=np.float64)
+    if len(signal) and -signal.min() > signal.max():
+        signal = -signal  # look for the pulses on whichever side they're strongest
+    periods, hop = track_periods(samples, sample_rate)
+    step = int(sample_rate * UNVOICED_MS / 1000)
+
+    marks = []
+    voiced = []
+    position = 0  # where the next mark is looked for
+    while position < len(signal):
+        frame = min(len(periods) - 1, (position + hop // 2) // hop)
+        period = int(periods[frame]) if frame >= 0 else 0
+        if period:
+            if voiced and voiced[-1]:  # continue the run of pulses
+                start, end = marks[-1] + int(0.8 * period), marks[-1] + int(1.2 * period) + 1
+            else:  # the first pulse after unvoiced speech is the peak of the next period
+                start, end = position, position + period
+            if start >= len(signal):
+                break
+            mark = start + int(np.argmax(signal[start:end]))
+            marks.append(mark)
+            voiced.append(True)
+            position = mark + period
+        else:
+            marks.append(position)
+            voiced.append(False)
+            position += step
+    return np.array(marks, dtype=np.int32), np.array(voiced, dtype=bool)
+
+
+def compile_marks(bank, marks_path=None):
+    """
+    One-time "compile marks" step for a diphone_bank.DiphoneBank: detect the pitch marks of every unit and save them
+    all to marks_path (next to the bank by default), tagged with the bank's version so a rebuilt bank isn't paired
+    with stale marks. Returns the number of marks.
+    """
+    marks_path = marks_path or bank.bank_path + MARKS_SUFFIX
+    unit_marks = []
+    unit_voiced = []
+    for unit_id, name in enumerate(bank.names):
+        marks, voiced = detect_marks(bank.unit(unit_id), bank.sample_rate(name))
+        unit_marks.append(marks)
+        unit_voiced.append(voiced)
+
+    starts = np.zeros(len(unit_marks) + 1, dtype=np.int64)  # unit i's marks are marks[starts[i]:starts[i + 1]]
+    np.cumsum([len(marks) for marks in unit_marks], out=starts[1:])
+    temp_path = marks_path + "." + str(os.getpid()) + ".tmp.npz"  # np.savez insists on the .npz extension
+    np.savez(temp_path, version=np.array(bank.version),
+             marks=np.concatenate(unit_marks) if unit_marks else np.zeros(0, dtype=np.int32),
+             voiced=np.concatenate(unit_voiced) if unit_voiced else np.zeros(0, dtype=bool), starts=starts)
+    os.replace(temp_path, marks_path)
+    return int(starts[-1])
+
+
+class PitchMarks:
+    """
+    The pitch mark index of a diphone bank, loaded whole (it is a small fraction of the size of the bank).
+    Primarily, use .unit(unit_id), for the (marks, voiced) arrays of a unit, addressed like DiphoneBank.unit.
+    """
+
+    def __init__(self, marks_path):
+        with np.load(marks_path) as index:
+            self.version = str(index["version"])
+            self.marks = index["marks"]
+            self.voiced = index["voiced"]
+            self.starts = index["starts"]
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def unit(self, unit_id):
+        start, end = self.starts[unit_id], self.starts[unit_id + 1]
+        return self.marks[start:end], self.voiced[start:end]
+
+
+def load_marks(bank, marks_path=None):
+    """Load the pitch marks compiled for bank, or return None if there are none, or they are for a different build."""
+    marks_path = marks_path or bank.bank_path + MARKS_SUFFIX
+    if not os.path.exists(marks_path):
+        return None
+    pitch_marks = PitchMarks(marks_path)
+    if pitch_marks.version != bank.version or len(pitch_marks) != len(bank):
+        print("Pitch marks in", marks_path, "are for a different build of the bank. Rebuild them with pitch_marks.py.")
+        return None
+    return pitch_marks
+
+
+if __name__ == "__main__":
+
+    import diphone_bank
+
+    parser = argparse.ArgumentParser(description="Detect the pitch marks of every diphone in a packed bank.")
+    parser.add_argument('--bank', default="./diphones.bank", help="Path of the packed bank built by diphone_bank.py")
+    args = parser.parse_args()
+
+    count = compile_marks(diphone_bank.DiphoneBank(args.bank))
+    print("Found", count, "pitch marks, written to", args.bank + MARKS_SUFFIX)
@@ -0,0 +1,108 @@
+# DiphoneSynth
+# Time-domain pitch-synchronous overlap-add (TD-PSOLA): change the duration and pitch of concatenated diphones, using
+# the pitch marks found once at build time by pitch_marks.py.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import bisect
+import numpy as np
+
+
+MAX_PERIOD_MS = 20  # longest grain half-length, so a gap between marks doesn't make one grain swallow its neighbours
+
+
+class Psola:
+    """
+    Cut the concatenated diphones into grains two periods long, centred on each pitch mark and tapered with a Hann
+    window, and overlap-add copies of them at new positions. Grains are placed one target period apart, so voiced
+    speech takes on the target pitch, and the time axis of each unit is stretched to its target duration by choosing
+    the grain nearest to the corresponding point of the original, repeating or dropping grains as needed. Unvoiced
+    grains keep their original spacing. Grains taken near a unit boundary span both units, which smooths the join.
+    All the analysis is in the precomputed marks, so the cost is one slice add per output grain.
+    Primarily, use Psola(sample_rate)(chunks, marks, voiced, durations, f0), where chunks is a list of int16 ndarrays.
+    """
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.max_period = int(sample_rate * MAX_PERIOD_MS / 1000)
+        self._windows = {}  # grain half-length -> Hann window, computed once per length
+
+    def window(self, half):
+        """A Hann window 2 * half + 1 long. Copies half apart sum to exactly 1."""
+        window = self._windows.get(half)
+        if window is None:
+            window = self._windows[half] = np.hanning(2 * half + 1).astype(np.float32)
+        return window
+
+    def __call__(self, chunks, marks, voiced, durations=None, f0=None, dtype=np.int16):
+        """
+        Resynthesise a list of chunks, where marks and voiced hold, for each chunk, the positions of its pitch marks
+        and whether each is voiced. durations holds the target length of each chunk in samples, and f0 its target
+        pitch in Hz, nan (or 0) to keep the recorded pitch. Either can be None to leave every chunk as it is.
+        """
+        if not chunks:
+            return np.array([], dtype=dtype)
+        lengths = np.array([len(chunk) for chunk in chunks], dtype=np.int64)
+        targets = lengths if durations is None else np.maximum(np.rint(durations), 0).astype(np.int64)
+        periods = np.full(len(chunks), np.nan)  # target period of each unit in samples, nan to keep the recorded one
+        if f0 is not None:
+            f0 = np.asarray(f0, dtype=np.float64)
+            np.divide(self.sample_rate, f0, out=periods, where=f0 > 0)
+        sources = np.concatenate(([0], np.cumsum(lengths))).tolist()  # where each unit starts, in and out
+        destinations = np.concatenate(([0], np.cumsum(targets))).tolist()
+        total = destinations[-1]
+
+        signal = np.concatenate(chunks).astype(np.float32)
+        analysis = np.concatenate([np.asarray(unit_marks, dtype=np.int64) + start
+                                   for unit_marks, start in zip(marks, sources)])
+        analysis_voiced = np.concatenate(voiced).tolist()
+        if not len(analysis):
+            return np.zeros(total, dtype=dtype)
+
+        # each grain spans the average of the gaps to its neighbouring marks, either side of its own mark
+        gaps = np.diff(analysis)
+        if len(gaps):
+            halves = (np.concatenate((gaps[:1], gaps)) + np.concatenate((gaps, gaps[-1:]))) // 2
+        else:
+            halves = np.array([self.max_period])
+        halves = np.clip(halves, 1, self.max_period).tolist()
+        # and is followed by the next grain one gap later, unless a target pitch says otherwise
+        steps = np.concatenate((gaps, [halves[-1]])).tolist()
+        analysis = analysis.tolist()
+        periods = periods.tolist()
+
+        pad = self.max_period  # room for grains hanging over either end
+        out = np.zeros(total + 2 * pad + 1, dtype=np.float32)
+        weight = np.zeros(total + 2 * pad + 1, dtype=np.float32)
+        unit = int(np.searchsorted(sources, analysis[0], side="right")) - 1  # the first mark's unit
+        # the next grain's position in the output, starting with the first mark's
+        position = destinations[unit] + (analysis[0] - sources[unit]) * targets[unit] / lengths[unit]
+        unit = 0
+        while position < total:
+            while position >= destinations[unit + 1]:  # skips units with a target length of 0 too
+                unit += 1
+            # the point of the original this output position maps to, and the mark nearest to it
+            source = sources[unit] + (position - destinations[unit]) * lengths[unit] / targets[unit]
+            k = bisect.bisect_left(analysis, source)
+            if k == len(analysis) or (k > 0 and source - analysis[k - 1] < analysis[k] - source):
+                k -= 1
+
+            half = halves[k]
+            window = self.window(half)
+            centre = analysis[k]
+            first = max(0, half - centre)  # the part of the grain inside the signal
+            last = min(2 * half + 1, len(signal) - centre + half)
+            at = int(position) - half + pad
+            out[at + first:at + last] += signal[centre - half + first:centre - half + last] * window[first:last]
+            weight[at + first:at + last] += window[first:last]
+
+            period = periods[unit]
+            position += period if analysis_voiced[k] and period == period else steps[k]  # period != period for nan
+
+        np.maximum(weight, 1, out=weight)  # where raising the pitch stacks grains, keep the level as it was
+        out /= weight
+        out = out[pad:pad + total]
+        info = np.iinfo(dtype)
+        np.clip(out, info.min, info.max, out=out)
+        np.rint(out, out=out)
+        return out.astype(dtype)
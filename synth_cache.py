@@ -0,0 +1,106 @@
+# DiphoneSynth
+# Content-addressed cache of synthesised audio: whole utterances in memory and optionally on disk, and phrases
+# (the runs of diphones between silences) in memory, so repeated prompts and repeated phrases aren't synthesised twice.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import os
+import re
+import json
+import hashlib
+import threading
+import numpy as np
+import audio_interface
+
+
+CACHE_BYTES = 256 * 2**20  # default memory limit for cached utterances
+PHRASE_CACHE_BYTES = 64 * 2**20  # default memory limit for cached phrases
+
+
+def pcm_size(data):
+    """Size in bytes of a cached ndarray."""
+    return data.nbytes
+
+
+def normalise_text(text):
+    """
+    Collapse whitespace, which doesn't change the synthesised audio, so it doesn't split the cache. Case is kept: it
+    decides where sentences end, e.g "a.m. Then" pauses after a.m. where "a.m. then" doesn't.
+    """
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class SynthCache:
+    """
+    Two-level cache of finished audio keyed by a hash of the normalised text and every option that changes the output
+    (crossfade, volume, overlap, window and the diphone bank version). The first level is a byte-limited LRU in memory,
+    the second an optional folder of .npy files that outlives the process. A separate in-memory LRU holds audio per
+    phrase, which Synth uses to reuse phrases shared between different utterances.
+    Primarily, use .key(text, **options), then .get(key) and .put(key, data),
+                   .stats(), for hit ratios to size the cache with.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES, disk_dir=None, phrase_max_bytes=PHRASE_CACHE_BYTES):
+        self.memory = audio_interface.UnitCache(max_bytes, pcm_size)
+        self.phrases = audio_interface.UnitCache(phrase_max_bytes, pcm_size)
+        self.disk_dir = disk_dir
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(text, **options):
+        """Content address of an utterance: a sha256 of the normalised text and the synthesis options."""
+        description = json.dumps([normalise_text(text), sorted(options.items())])
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".npy")  # shard by prefix to keep folders small
+
+    def get(self, key):
+        """Return the cached audio for key from memory, then disk, or None if neither has it."""
+        data = self.memory.get(key)
+        if data is not None or not self.disk_dir:
+            return data
+        try:
+            data = np.load(self.disk_path(key))
+        except (OSError, ValueError):  # missing, or a partial file from a crashed writer
+            with self._lock:
+                self.disk_misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        data.setflags(write=False)
+        self.memory.put(key, data)  # promote to memory for next time
+        return data
+
+    def put(self, key, data):
+        """Cache finished audio in memory and, if enabled, on disk."""
+        data.setflags(write=False)  # shared between requests from now on
+        self.memory.put(key, data)
+        if self.disk_dir:
+            path = self.disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+            with open(temp_path, "wb") as temp_file:
+                np.save(temp_file, data)
+            os.replace(temp_path, path)  # atomic, so readers never see a half-written file
+
+    def get_phrase(self, key):
+        return self.phrases.get(key)
+
+    def put_phrase(self, key, data):
+        data.setflags(write=False)
+        self.phrases.put(key, data)
+
+    def stats(self):
+        """Return counters for each level, with hit ratios."""
+        stats = {"utterances": self.memory.stats(), "phrases": self.phrases.stats()}
+        if self.disk_dir:
+            stats["disk"] = {"hits": self.disk_hits, "misses": self.disk_misses}
+        for level in stats.values():
+            lookups = level["hits"] + level["misses"]
+            level["hit_ratio"] = level["hits"] / lookups if lookups else 0.0
+        return stats
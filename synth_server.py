@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+# DiphoneSynth
+# Long-running synthesis daemon: loads the lexicon and diphone bank once, then serves synthesis requests over
+# localhost HTTP or a Unix socket.
+# hypnaceae on github
+# License: GNU GPL v3
+
+import io
+import os
+import json
+import math
+import time
+import argparse
+import http.server
+import socketserver
+import threading
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+import audio_interface
+import diphone_synth
+import instrumentation
+import lexicon
+import output_dsp
+import synth_cache
+import overlap_add
+
+
+METRICS_INTERVAL = 10  # seconds between rewrites of the --metrics-prom file
+KEEP_ALIVE_SECONDS = 1  # how long an idle keep-alive connection may hold a worker, waiting for its next request
+
+
+class SynthService:
+    """
+    Warm synthesis state shared by every request: the lexicon, the diphone bank and a Synth object are loaded once
+    here instead of once per utterance. With a synth_cache.SynthCache, repeated utterances and phrases are served
+    from the cache. Audio is resampled to rate (diphone_synth.SAMPLE_RATE by default) and its volume normalised by the
+    peak or RMS level, by an output_dsp.OutputStage per thread, whose buffers are reused from request to request.
+    Primarily, use .synthesise(phrase, crossfade, volume), which returns an int16 ndarray,
+                   .wav_bytes(phrase, crossfade, volume), which returns the same audio as a complete .wav file.
+    """
+
+    def __init__(self, wav_folder="./diphones", bank_path="./diphones.bank", overlap_ms=overlap_add.OVERLAP_MS,
+                 window="linear", lexicon_path=lexicon.LEXICON_PATH, cache=None, rate=None, normalise="peak"):
+        self.lexicon = lexicon.load_lexicon(lexicon_path)  # the slow part of every cold start, done once
+        self.bank = diphone_synth.load_bank(bank_path)
+        self.cache = cache
+        self.synth = diphone_synth.Synth(self.bank, overlap_ms, window, wav_folder, cache)
+        self.rate = rate or diphone_synth.SAMPLE_RATE
+        self.normalise = normalise
+        output_dsp.OutputStage(diphone_synth.SAMPLE_RATE, self.rate, normalise)  # fail early on a bad option
+        self.local = threading.local()  # each thread's output stage
+
+    def output_stage(self):
+        """This thread's output stage, created on first use."""
+        stage = getattr(self.local, "output_stage", None)
+        if stage is None:
+            stage = self.local.output_stage = output_dsp.OutputStage(diphone_synth.SAMPLE_RATE, self.rate,
+                                                                     self.normalise)
+        return stage
+
+    def finish(self, data, volume=100):
+        """Resample and normalise concatenated audio data on this thread's output stage, returning a copy."""
+        return self.output_stage().process(data, volume).copy()
+
+    def synthesise(self, phrase, crossfade=False, volume=100):
+        """Turn a phrase into audio data at self.rate, scaled like the command line --volume."""
+        if not 0 <= volume <= 100:
+            raise ValueError("volume expected a value between 0 and 100.")
+        with instrumentation.metrics.stage("synthesise", crossfade=crossfade) as stage:
+            if self.cache is not None:
+                key = self.cache_key(phrase, crossfade, volume)
+                data = self.cache.get(key)
+                instrumentation.metrics.count("utterance_cache_hits" if data is not None else "utterance_cache_misses")
+                stage.fields["cached"] = data is not None
+                if data is not None:
+                    return data
+
+            utt = diphone_synth.Utterance(phrase, self.lexicon)
+            utt.tokenise()
+            data = self.finish(self.synth.make_and_concatenate_chunks(utt.get_diphone_ids(), crossfade), volume)
+
+            if self.cache is not None:
+                self.cache.put(key, data)
+            return data
+
+    def cache_key(self, phrase, crossfade=False, volume=100):
+        """The utterance cache key of a phrase synthesised with these options."""
+        return self.cache.key(phrase, crossfade=crossfade, volume=volume, overlap=self.synth.crossfader.overlap,
+                              window=self.synth.crossfader.window, diphones=self.synth.version(), rate=self.rate,
+                              normalise=self.normalise)
+
+    def stats(self):
+        """Return cache hit ratios for the utterance, phrase and word (lexicon) levels, and the pipeline metrics."""
+        stats = self.cache.stats() if self.cache is not None else {}
+        words = self.lexicon.pronounce_ids.cache_info()
+        lookups = words.hits + words.misses
+        stats["words"] = {"hits": words.hits, "misses": words.misses, "entries": words.currsize,
+                          "hit_ratio": words.hits / lookups if lookups else 0.0}
+        stats["pipeline"] = instrumentation.metrics.snapshot()
+        return stats
+
+    def wav_bytes(self, phrase, crossfade=False, volume=100):
+        """Synthesise a phrase and return it as the bytes of a .wav file."""
+        wav_file = io.BytesIO()
+        audio_interface.write_wav(wav_file, self.synthesise(phrase, crossfade, volume), self.rate)
+        return wav_file.getvalue()
+
+
+def parse_volume(value):
+    """Read a request's volume, a finite number or a string of one, as an int. Raises ValueError for anything else."""
+    try:
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError
+        volume = float(value)
+        if not math.isfinite(volume):
+            raise ValueError
+        return int(volume)
+    except (ValueError, OverflowError):
+        raise ValueError("volume expected a number between 0 and 100.") from None
+
+
+class SynthRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handle GET /synthesise?text=...&crossfade=1&volume=80&format=wav and POST /synthesise with a JSON body holding the
+    same fields. The response is a .wav file (audio/wav), or raw 16-bit mono PCM (audio/L16) with format=pcm.
+    GET /stats returns cache and pipeline statistics as JSON, and GET /metrics the same metrics for Prometheus.
+    A connection holds a worker for as long as it is open, so a kept-alive connection is closed after
+    KEEP_ALIVE_SECONDS without a request, or straight after its response if other connections are waiting for a worker.
+    """
+
+    protocol_version = "HTTP/1.1"  # keep-alive, so a client can send many requests over one connection
+    timeout = 30  # for reading a request and writing its response
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        """Wait up to KEEP_ALIVE_SECONDS for the next request on a kept-alive connection. False if none came."""
+        self.connection.settimeout(KEEP_ALIVE_SECONDS)
+        try:
+            return bool(self.rfile.peek(1))  # a pipelined request may be buffered already. b"" if the client closed
+        except OSError:  # timed out
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") == "/stats":
+            self.send_body(json.dumps(self.server.service.stats()).encode("utf-8"), "application/json")
+            return
+        if url.path.rstrip("/") == "/metrics":
+            body = instrumentation.prometheus_text(instrumentation.metrics.snapshot()).encode("utf-8")
+            self.send_body(body, "text/plain; version=0.0.4")
+            return
+        options = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self.respond(url.path, options)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            self.send_error(400, "Content-Length expected a number of bytes")
+            return
+        try:
+            options = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_error(400, "Request body is not valid JSON")
+            return
+        if not isinstance(options, dict):
+            self.send_error(400, "Request body is not a JSON object")
+            return
+        self.respond(url.path, options)
+
+    def respond(self, path, options):
+        """Synthesise the requested text and write it back as the response body."""
+        if path.rstrip("/") != "/synthesise":
+            self.send_error(404, "Expected /synthesise")
+            return
+        try:
+            text = options["text"]
+            if not isinstance(text, str):
+                raise ValueError("text expected a string.")
+            crossfade = str(options.get("crossfade", False)).lower() in ("1", "true", "yes")
+            volume = parse_volume(options.get("volume", 100))
+            output_format = options.get("format", "wav")
+            if output_format == "wav":
+                body = self.server.service.wav_bytes(text, crossfade, volume)
+                content_type = "audio/wav"
+            elif output_format == "pcm":
+                body = self.server.service.synthesise(text, crossfade, volume).tobytes()
+                content_type = "audio/L16; rate=" + str(self.server.service.rate) + "; channels=1"
+            else:
+                raise ValueError("format expected wav or pcm.")
+        except KeyError:
+            self.send_error(400, "Missing text to synthesise")
+            return
+        except (ValueError, TypeError, OverflowError) as e:
+            self.send_error(400, str(e))
+            return
+        except (ImportError, LookupError) as e:  # the tokeniser isn't installed, or NLTK's punkt data is missing
+            self.log_error("Synthesis failed: %s", e)
+            self.send_error(500, "Synthesis failed: " + type(e).__name__)
+            return
+        self.send_body(body, content_type)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.saturated():  # free this worker for a connection that is waiting for one
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class PooledServerMixIn:
+    """Handle each connection on a fixed-size pool of worker threads instead of a new thread per connection."""
+
+    metrics_path = None  # a Prometheus text file to keep up to date with the pipeline metrics, or None
+    metrics_written = 0.0
+
+    def init_pool(self, service, workers):
+        self.service = service
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="synth-worker")
+        self.connections = 0  # open connections, whether on a worker or waiting for one
+        self.connections_lock = threading.Lock()
+
+    def saturated(self):
+        """True if some connection is waiting for a worker."""
+        return self.connections > self.workers
+
+    def service_actions(self):
+        # called by serve_forever between requests, so the metrics file is refreshed without a thread of its own
+        if self.metrics_path and time.monotonic() - self.metrics_written >= METRICS_INTERVAL:
+            instrumentation.write_prometheus(self.metrics_path)
+            self.metrics_written = time.monotonic()
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections += 1
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.connections_lock:
+                self.connections -= 1
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+class PooledHTTPServer(PooledServerMixIn, http.server.HTTPServer):
+    pass
+
+
+class PooledUnixHTTPServer(PooledServerMixIn, socketserver.UnixStreamServer):
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)  # clear a stale socket left behind by a previous run
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+def make_server(service, host="127.0.0.1", port=8642, unix_socket=None, workers=4):
+    """Build a server for the given SynthService, on a Unix socket if one is given, otherwise on host:port."""
+    if unix_socket:
+        server = PooledUnixHTTPServer(unix_socket, SynthRequestHandler)
+    else:
+        server = PooledHTTPServer((host, port), SynthRequestHandler)
+    server.init_pool(service, workers)
+    return server
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve diphone synthesis requests from a long-running process.")
+    parser.add_argument('--diphones', default="./diphones", help="Relative path to folder containing diphone .wavs")
+    parser.add_argument('--bank', default="./diphones.bank",
+                        help="Path to a packed diphone bank built by diphone_bank.py. Used instead of --diphones if "
+                             "it exists")
+    parser.add_argument('--lexicon', default=lexicon.LEXICON_PATH,
+                        help="Path to a compiled lexicon built by lexicon.py. CMUdict is loaded through NLTK if it "
+                             "doesn't exist")
+    parser.add_argument('--overlap-ms', default=overlap_add.OVERLAP_MS, type=float,
+                        help="Length in milliseconds of the crossfade between neighbouring diphones")
+    parser.add_argument('--window', default="linear", choices=overlap_add.WINDOWS, help="Shape of the crossfade taper")
+    parser.add_argument('--normalise', default="peak", choices=output_dsp.NORMALISATIONS,
+                        help="Scale the volume by the peak sample, or by the RMS level")
+    parser.add_argument('--rate', default=diphone_synth.SAMPLE_RATE, type=int,
+                        help="Sample rate in Hz of the audio served, e.g 8000, 22050 or 48000")
+    parser.add_argument('--cache-mb', default=synth_cache.CACHE_BYTES // 2**20, type=int,
+                        help="Memory in MB for caching finished utterances. 0 disables caching")
+    parser.add_argument('--cache-dir', default=None,
+                        help="Folder to also keep finished utterances in, so the cache survives restarts")
+    parser.add_argument('--host', default="127.0.0.1", help="Address to listen on for HTTP requests")
+    parser.add_argument('--port', default=8642, type=int, help="Port to listen on for HTTP requests")
+    parser.add_argument('--unix-socket', default=None, help="Listen on this Unix socket path instead of host:port")
+    parser.add_argument('--workers', default=4, type=int, help="Number of requests synthesised concurrently")
+    parser.add_argument('--metrics-log', default=None, help="Append a JSON line per pipeline stage to this file")
+    parser.add_argument('--metrics-prom', default=None,
+                        help="Keep this Prometheus text file up to date with the pipeline metrics")
+    args = parser.parse_args()
+
+    if args.overlap_ms < 0:
+        print("--overlap-ms expected a length of 0 or more milliseconds.")
+        quit(0)
+
+    if args.metrics_log:
+        instrumentation.metrics.add_hook(instrumentation.JsonLinesExporter(args.metrics_log))
+
+    print("Loading lexicon and diphones...")
+    pcm_cache = None
+    if args.cache_mb > 0:
+        pcm_cache = synth_cache.SynthCache(args.cache_mb * 2**20, args.cache_dir)
+    synth_service = SynthService(args.diphones, args.bank, args.overlap_ms, args.window, args.lexicon, pcm_cache,
+                                 args.rate, args.normalise)
+    synth_server = make_server(synth_service, args.host, args.port, args.unix_socket, args.workers)
+    synth_server.metrics_path = args.metrics_prom
+    print("Serving on", args.unix_socket or "http://" + args.host + ":" + str(args.port) + "/synthesise")
+    try:
+        synth_server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping...")
+    finally:
+        synth_server.server_close()
+        if args.metrics_prom:
+            instrumentation.write_prometheus(args.metrics_prom)